@@ -1,35 +1,134 @@
 import argparse
 import asyncio
+import calendar
+import csv
 import ipaddress
 import json
 import os
 import sys
+import time
 from collections import OrderedDict
-from datetime import datetime, timedelta
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 import meraki.aio
 
+try:
+    import pyarrow
+    import pyarrow.dataset
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_TREND_DAYS = 90
+# the oldest t0 the changelog endpoint accepts
+MAX_CHANGELOG_AGE = 365 * 86400
+CHANGELOG_SLACK = 3600
+
+HISTORY_COLUMNS = [
+    "ts",
+    "organization_id",
+    "organization",
+    "templates",
+    "pool",
+    "mask",
+    "total",
+    "used",
+    "free",
+]
+
+FREE = 0
+USED = 1
+
 
 class SubnetPool:
+    """ a subnetPool of a template, which is divided into slots of the size of its mask
+
+    The allocation map has one byte per slot (FREE or USED). It is created on the first
+    access, since the network and mask can still grow while the pools are consolidated.
+    """
+
     def __init__(self, network: ipaddress.IPv4Network, mask: int):
         self.network = network
         self.mask = mask
-        self.usedAddresses = 0
+        self.templates = set()
+        self._slots = None
 
     def __str__(self):
         return f"{self.network} mask {self.mask}"
 
+    @property
+    def slots(self) -> bytearray:
+        if self._slots is None:
+            self._slots = bytearray(1 << (self.mask - self.network.prefixlen))
+        return self._slots
+
+    @property
+    def total_slots(self) -> int:
+        return len(self.slots)
+
+    @property
+    def used_slots(self) -> int:
+        return self.slots.count(USED)
+
+    @property
+    def free_slots(self) -> int:
+        return self.total_slots - self.used_slots
+
+    def slot_subnet(self, slot: int) -> ipaddress.IPv4Network:
+        address = int(self.network.network_address) + (slot << (32 - self.mask))
+        return ipaddress.IPv4Network((address, self.mask))
+
+    def mark_used(self, address: int, prefixlen: int):
+        """ marks all slots which overlap with the subnet as used """
+        first = (address - int(self.network.network_address)) >> (32 - self.mask)
+        count = 1 << (self.mask - prefixlen) if prefixlen < self.mask else 1
+        self.slots[first : first + count] = bytes([USED]) * count
+
+    def free_subnets(self, limit: int = None) -> List[ipaddress.IPv4Network]:
+        """ returns the free slots (up to limit) as subnets in ascending order """
+        result = []
+        slot = self.slots.find(FREE)
+        while slot != -1 and (limit is None or len(result) < limit):
+            result.append(self.slot_subnet(slot))
+            slot = self.slots.find(FREE, slot + 1)
+        return result
+
+    def allocate(self, count: int = 1) -> List[ipaddress.IPv4Network]:
+        """ marks the next count free slots as used and returns them """
+        subnets = self.free_subnets(count)
+        if len(subnets) < count:
+            raise ValueError(f"{self} has only {len(subnets)} free subnetworks")
+        for subnet in subnets:
+            self.mark_used(int(subnet.network_address), self.mask)
+        return subnets
 
-def filter_changelog(changelog, template_id):
+    def largest_free_block(self) -> int:
+        """ returns the number of slots of the largest contiguous free block """
+        largest = 0
+        start = self.slots.find(FREE)
+        while start != -1:
+            end = self.slots.find(USED, start)
+            if end == -1:
+                end = self.total_slots
+            largest = max(largest, end - start)
+            start = self.slots.find(FREE, end)
+        return largest
+
+    def fragmentation(self) -> float:
+        """ 0 if all free slots are one contiguous block, close to 1 if they are scattered """
+        free = self.free_slots
+        return 1 - self.largest_free_block() / free if free else 0.0
+
+
+def filter_changelog(changelog, template_ids):
     result = []
     for c in changelog:
-        if not "networkId" in c.keys():
-            continue
         if (
-            c["page"] != "Addressing & VLANs"
-            or c["label"] != "Vlans Config template options"
-            or c["networkId"] != template_id
+            c.get("page") != "Addressing & VLANs"
+            or c.get("label") != "Vlans Config template options"
+            or c.get("networkId") not in template_ids
         ):
             continue
         result.append(c)
@@ -44,17 +143,108 @@ def parse_vlan_config_template(options: str) -> Dict:
 
 def extract_ts(js):
     """ just a helper function for sorting the changelog """
-    dt = datetime.strptime(js["ts"], "%Y-%m-%dT%H:%M:%S.%fZ")
-    ts = dt.timestamp()
-    return int(ts)
+    # the timestamps have a fixed format (2020-04-02T10:11:12.123456Z), so slicing is much faster than strptime
+    ts = js["ts"]
+    return calendar.timegm(
+        (
+            int(ts[0:4]),
+            int(ts[5:7]),
+            int(ts[8:10]),
+            int(ts[11:13]),
+            int(ts[14:16]),
+            int(ts[17:19]),
+        )
+    )
+
+
+def load_changelog(path: str) -> Optional[Dict]:
+    """ returns the cached changelog or None if there is no usable cache """
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring changelog cache {path}: {e}")
+        return None
+    # older caches only contain the list of changes
+    if isinstance(cache, list):
+        return {"synced_at": 0, "changes": cache}
+    return cache
+
+
+def save_changelog(path: str, cache: Dict):
+    # write to a temporary file first, so that an aborted run can't corrupt the cache
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, path)
+
+
+def format_ts(ts: float) -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(ts))
+
+
+async def get_changelog(
+    aiomeraki: meraki.aio.AsyncDashboardAPI, organization_id: str, cache_dir: str = None
+) -> List[Dict]:
+    """ downloads the changelog of the organization
 
+    With a cache_dir, the changelog is stored on disk and only the changes since the newest
+    stored entry (or the last download, if the changelog is empty) are downloaded. The cache
+    keeps the entries which are no longer available in the dashboard.
+    """
+    if not cache_dir:
+        return await aiomeraki.change_log.getOrganizationConfigurationChanges(
+            organization_id, total_pages=-1
+        )
 
-def get_template_subnet_ranges(template_id: str, changelog):
-    """ this method will extract all subnets from the changelog for a given template"""
-    changes = filter_changelog(changelog, template_id)
+    path = os.path.join(cache_dir, f"{organization_id}.json")
+    cache = load_changelog(path)
+    synced_at = time.time()
+    if cache is None:
+        changelog = await aiomeraki.change_log.getOrganizationConfigurationChanges(
+            organization_id, total_pages=-1
+        )
+    else:
+        changelog = cache["changes"]
+        # some slack, so that changes which show up late in the changelog aren't missed
+        t0 = max(
+            [c["ts"] for c in changelog]
+            + [format_ts(cache["synced_at"] - CHANGELOG_SLACK)]
+        )
+        # the dashboard only accepts a t0 within the last year
+        oldest = time.time() - MAX_CHANGELOG_AGE + 3600
+        if extract_ts({"ts": t0}) < oldest:
+            print(
+                f"The changelog cache of {organization_id} is older than the dashboard retention, the changes between {t0} and {format_ts(oldest)} are lost"
+            )
+            t0 = format_ts(oldest)
+        changes = await aiomeraki.change_log.getOrganizationConfigurationChanges(
+            organization_id, t0=t0, total_pages=-1
+        )
+        # t0 is inclusive, so the newest stored entries can be downloaded again
+        known = {json.dumps(c, sort_keys=True) for c in changelog if c["ts"] >= t0}
+        new_changes = [c for c in changes if json.dumps(c, sort_keys=True) not in known]
+        print(f"Downloaded {len(new_changes)} new changelog entries")
+        changelog.extend(new_changes)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    save_changelog(path, {"synced_at": synced_at, "changes": changelog})
+    return changelog
+
+
+def get_template_subnet_ranges(template_ids: List[str], changelog) -> Dict[str, List]:
+    """ this method will extract all subnets from the changelog for the given templates
+
+    The changelog is filtered and sorted once and the changes are replayed for all templates
+    in a single pass.
+    """
+    changes = filter_changelog(changelog, set(template_ids))
     changes.sort(key=extract_ts)
-    subnets = []
+    template_subnets = {t: [] for t in template_ids}
     for c in changes:
+        subnets = template_subnets[c["networkId"]]
         oldValue = parse_vlan_config_template(c["oldValue"])
         newValue = parse_vlan_config_template(c["newValue"])
         if oldValue or not newValue:
@@ -62,37 +252,311 @@ def get_template_subnet_ranges(template_id: str, changelog):
                 subnets.remove(oldValue)
         if newValue:
             subnets.append(newValue)
-    return subnets
+    return template_subnets
 
 
 def get_supernetworks(subnetRanges) -> List[SubnetPool]:
-    superNetworks = []
+    """ consolidates the subnet ranges into the largest non overlapping supernetworks
+
+    CIDR networks are either nested or disjoint, so after sorting them by their first address
+    (and the larger network first) a network is part of the current supernetwork if it starts
+    before the supernetwork ends.
+    """
+    ranges = []
     for x in subnetRanges:
         network = ipaddress.IPv4Network(x["subnetPool"])
-        mask = int(x["mask"])
-        addNetwork = True
-        for superNetwork in superNetworks:
-            if network == superNetwork.network:
-                addNetwork = False
-                if superNetwork.mask < mask:
-                    superNetwork.mask = mask
-                break
-            if network.subnet_of(superNetwork.network):
-                addNetwork = False
-                if superNetwork.mask < mask:
-                    superNetwork.mask = mask
-                break
-            if network.supernet_of(superNetwork.network):
-                superNetwork.network = network
-                if superNetwork.mask < mask:
-                    superNetwork.mask = mask
-                addNetwork = False
-                break
-        if addNetwork:
-            superNetworks.append(SubnetPool(network, mask))
+        ranges.append(
+            (
+                int(network.network_address),
+                int(network.broadcast_address),
+                int(x["mask"]),
+                network,
+                x.get("template"),
+            )
+        )
+    ranges.sort(key=lambda r: (r[0], -r[1]))
+
+    superNetworks = []
+    end = -1
+    for first, last, mask, network, template in ranges:
+        if first <= end:
+            superNetwork = superNetworks[-1]
+            if superNetwork.mask < mask:
+                superNetwork.mask = mask
+        else:
+            superNetwork = SubnetPool(network, mask)
+            superNetworks.append(superNetwork)
+            end = last
+        if template:
+            superNetwork.templates.add(template)
     return superNetworks
 
 
+def parse_subnet(subnet: str):
+    """ parses an ipv4 subnet like 10.0.0.0/24 into its address as int and prefix length """
+    address, _, prefixlen = subnet.partition("/")
+    a, b, c, d = address.split(".")
+    return (
+        (int(a) << 24) | (int(b) << 16) | (int(c) << 8) | int(d),
+        int(prefixlen) if prefixlen else 32,
+    )
+
+
+class SupernetworkIndex:
+    """ longest prefix match of subnets to their supernetwork
+
+    The supernetworks are stored in one dict per prefix length, so a lookup needs at most
+    one dict access per distinct prefix length.
+    """
+
+    def __init__(self, supernetworks: List[SubnetPool]):
+        self.prefixes = {}
+        for superNetwork in supernetworks:
+            self.prefixes.setdefault(superNetwork.network.prefixlen, {})[
+                int(superNetwork.network.network_address)
+            ] = superNetwork
+        self.prefixlens = [
+            (length, (0xFFFFFFFF << (32 - length)) & 0xFFFFFFFF, self.prefixes[length])
+            for length in sorted(self.prefixes, reverse=True)
+        ]
+
+    def lookup(self, address: int, prefixlen: int) -> SubnetPool:
+        for length, netmask, networks in self.prefixlens:
+            if length > prefixlen:
+                continue
+            superNetwork = networks.get(address & netmask)
+            if superNetwork:
+                return superNetwork
+        return None
+
+
+async def limited(semaphore: asyncio.Semaphore, coro):
+    """ awaits the given coroutine while holding a slot of the semaphore """
+    async with semaphore:
+        return await coro
+
+
+async def analyze_organization(
+    aiomeraki: meraki.aio.AsyncDashboardAPI,
+    organization: Dict,
+    semaphore: asyncio.Semaphore,
+    cache_dir: str = None,
+):
+    """ calculates the usage of the subnetPools of the organization
+
+    returns the organization and its supernetworks, or None if the organization doesn't have any templates
+    """
+    name = organization["name"]
+    print(f"Analyzing organization {name}")
+
+    # dirty hack: download the changelog to read the subnetPool ranges
+    # the changelog is the slowest download, so the templates and networks are downloaded at the same time
+    print(f"{name}: Downloading Changelog, templates and networks")
+    changelog, templates, networks = await asyncio.gather(
+        limited(semaphore, get_changelog(aiomeraki, organization["id"], cache_dir)),
+        limited(
+            semaphore,
+            aiomeraki.config_templates.getOrganizationConfigTemplates(
+                organization["id"]
+            ),
+        ),
+        limited(
+            semaphore, aiomeraki.networks.getOrganizationNetworks(organization["id"])
+        ),
+    )
+    if len(templates) == 0:
+        print(f"{name}: Organization doesn't have any templates defined")
+        return organization, None
+
+    template_names = {}
+    for t in templates:
+        print(f"{name}: Analyzing template {t['name']}")
+        if "appliance" not in t["productTypes"]:
+            continue
+        template_names[t["id"]] = t["name"]
+    subnetRanges = []
+    for template_id, subnets in get_template_subnet_ranges(
+        list(template_names), changelog
+    ).items():
+        subnetRanges.extend(
+            dict(x, template=template_names[template_id]) for x in subnets
+        )
+    supernetworks = get_supernetworks(subnetRanges)
+
+    vlan_tasks = []
+    for n in networks:
+        if not ("configTemplateId" in n.keys() and "appliance" in n["productTypes"]):
+            continue
+        vlan_tasks.append(limited(semaphore, aiomeraki.vlans.getNetworkVlans(n["id"])))
+
+    print(f"{name}: Downloading VLAN information")
+    index = SupernetworkIndex(supernetworks)
+    for task in asyncio.as_completed(vlan_tasks):
+        vlans = await task
+        for v in vlans:
+            address, prefixlen = parse_subnet(v["subnet"])
+            superNetwork = index.lookup(address, prefixlen)
+            if superNetwork:
+                superNetwork.mark_used(address, prefixlen)
+    return organization, supernetworks
+
+
+def print_statistics(organization: Dict, supernetworks: List[SubnetPool]):
+    print(f"Organization {organization['name']}")
+    print("Largest supernetworks:")
+    for x in supernetworks:
+        print(x)
+
+    for superNetwork in supernetworks:
+        total_subnets = superNetwork.total_slots
+        used_subnets = superNetwork.used_slots
+        free_subnets = total_subnets - used_subnets
+        print(
+            f"{superNetwork} subnetworks: total={total_subnets} used={used_subnets} free={free_subnets} -> usage {100*used_subnets/total_subnets}%"
+        )
+        if free_subnets:
+            print(
+                f"{superNetwork} next free={superNetwork.free_subnets(1)[0]} largest free block={superNetwork.largest_free_block()} fragmentation={100*superNetwork.fragmentation():.1f}%"
+            )
+
+
+def history_rows(ts: int, organization: Dict, supernetworks: List[SubnetPool]):
+    for superNetwork in supernetworks:
+        used = superNetwork.used_slots
+        yield {
+            "ts": ts,
+            "organization_id": organization["id"],
+            "organization": organization["name"],
+            "templates": ";".join(sorted(superNetwork.templates)),
+            "pool": str(superNetwork.network),
+            "mask": superNetwork.mask,
+            "total": superNetwork.total_slots,
+            "used": used,
+            "free": superNetwork.total_slots - used,
+        }
+
+
+def use_parquet(path: str) -> bool:
+    """ the history is a directory of parquet files if it ends with .parquet or already is a directory, otherwise a csv file """
+    return path.endswith(".parquet") or os.path.isdir(path)
+
+
+def save_history(path: str, rows: List[Dict]):
+    """ appends the rows of this run to the usage history """
+    if not rows:
+        return
+    if use_parquet(path):
+        # parquet files can't be appended, so every run adds its own file to the dataset
+        os.makedirs(path, exist_ok=True)
+        table = pyarrow.Table.from_pydict(
+            {c: [row[c] for row in rows] for c in HISTORY_COLUMNS}
+        )
+        pyarrow.parquet.write_table(
+            table, os.path.join(path, f"usage-{rows[0]['ts']}.parquet")
+        )
+        return
+
+    new_file = not os.path.exists(path)
+    with open(path, "a", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=HISTORY_COLUMNS)
+        if new_file:
+            writer.writeheader()
+        writer.writerows(rows)
+
+
+def read_history(path: str, since: int):
+    """ yields the rows of the usage history since the given timestamp without loading the whole history """
+    if use_parquet(path):
+        dataset = pyarrow.dataset.dataset(path, format="parquet")
+        for batch in dataset.to_batches(
+            columns=HISTORY_COLUMNS, filter=pyarrow.dataset.field("ts") >= since
+        ):
+            yield from batch.to_pylist()
+        return
+
+    with open(path, "r", newline="") as f:
+        for row in csv.DictReader(f):
+            if int(row["ts"]) < since:
+                continue
+            for c in ("ts", "mask", "total", "used", "free"):
+                row[c] = int(row[c])
+            yield row
+
+
+class PoolTrend:
+    """ a running least squares fit of the used subnetworks of a pool over time """
+
+    def __init__(self, row: Dict):
+        self.organization = row["organization"]
+        self.pool = row["pool"]
+        self.mask = row["mask"]
+        # days relative to the first row keep the sums small
+        self.t0 = row["ts"]
+        self.n = 0
+        self.sum_t = 0.0
+        self.sum_u = 0.0
+        self.sum_tt = 0.0
+        self.sum_tu = 0.0
+        self.last = row
+
+    def add(self, row: Dict):
+        t = (row["ts"] - self.t0) / 86400
+        u = row["used"]
+        self.n += 1
+        self.sum_t += t
+        self.sum_u += u
+        self.sum_tt += t * t
+        self.sum_tu += t * u
+        if row["ts"] >= self.last["ts"]:
+            self.last = row
+
+    @property
+    def growth(self) -> float:
+        """ the growth in subnetworks per day """
+        denominator = self.n * self.sum_tt - self.sum_t * self.sum_t
+        if self.n < 2 or denominator == 0:
+            return 0.0
+        return (self.n * self.sum_tu - self.sum_t * self.sum_u) / denominator
+
+    @property
+    def days_to_exhaustion(self) -> Optional[float]:
+        growth = self.growth
+        if growth <= 0:
+            return None
+        return self.last["free"] / growth
+
+
+def get_trends(path: str, days: int = DEFAULT_TREND_DAYS, organizations=None) -> List[PoolTrend]:
+    """ calculates the growth of every pool over the last days of the usage history """
+    since = int(time.time()) - days * 86400
+    trends = {}
+    for row in read_history(path, since):
+        if organizations and not (
+            row["organization_id"] in organizations
+            or row["organization"] in organizations
+        ):
+            continue
+        key = (row["organization_id"], row["pool"], row["mask"])
+        if key not in trends:
+            trends[key] = PoolTrend(row)
+        trends[key].add(row)
+    return list(trends.values())
+
+
+def print_trends(trends: List[PoolTrend]):
+    for trend in sorted(
+        trends,
+        key=lambda t: t.days_to_exhaustion
+        if t.days_to_exhaustion is not None
+        else float("inf"),
+    ):
+        days = trend.days_to_exhaustion
+        exhaustion = f"exhausted in {days:.0f} days" if days is not None else "not growing"
+        print(
+            f"{trend.organization} {trend.pool} mask {trend.mask}: used={trend.last['used']} free={trend.last['free']} growth={trend.growth:.2f}/day -> {exhaustion}"
+        )
+
+
 async def main():
 
     parser = argparse.ArgumentParser(
@@ -104,10 +568,51 @@ async def main():
         type=str,
         nargs="+",
         dest="organizations",
-        required=True,
+        required=False,
         help="the name/id of the organization(s) you want to analyze",
     )
 
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        dest="concurrency",
+        default=DEFAULT_CONCURRENCY,
+        required=False,
+        help=f"the maximum number of concurrent requests over all organizations. Default: {DEFAULT_CONCURRENCY}",
+    )
+
+    parser.add_argument(
+        "--changelog-cache",
+        type=str,
+        dest="cache_dir",
+        required=False,
+        help="a directory to store the changelog of every organization. The next run will only download the new changes",
+    )
+
+    parser.add_argument(
+        "--history",
+        type=str,
+        dest="history",
+        required=False,
+        help="append the usage of every pool to this history. A directory of parquet files (needs pyarrow) if it ends with .parquet, otherwise a csv file",
+    )
+
+    parser.add_argument(
+        "--trend",
+        dest="trend",
+        action="store_true",
+        help="print the growth and the days until exhaustion of every pool from the --history instead of analyzing the organizations",
+    )
+
+    parser.add_argument(
+        "--trend-days",
+        type=int,
+        dest="trend_days",
+        default=DEFAULT_TREND_DAYS,
+        required=False,
+        help=f"the number of days of the history which are used for the --trend. Default: {DEFAULT_TREND_DAYS}",
+    )
+
     if len(sys.argv) < 2:
         parser.print_help()
         return
@@ -121,6 +626,26 @@ async def main():
         parser.print_help()
         return
 
+    if args.history and use_parquet(args.history) and pyarrow is None:
+        print(f"{args.history} is a parquet history, please install pyarrow")
+        return
+
+    if args.trend:
+        if not args.history:
+            print("--trend needs a --history")
+            parser.print_help()
+            return
+        if not os.path.exists(args.history):
+            print(f"There is no history at {args.history}")
+            return
+        print_trends(get_trends(args.history, args.trend_days, args.organizations))
+        return
+
+    if not args.organizations:
+        print("please specify the organization(s) with -o")
+        parser.print_help()
+        return
+
     # Instantiate a Meraki dashboard API session
     # NOTE: you have to use "async with" so that the session will be closed correctly at the end of the usage
     async with meraki.aio.AsyncDashboardAPI(
@@ -131,68 +656,22 @@ async def main():
     ) as aiomeraki:
         # Get list of organizations to which API key has access
         organizations = await aiomeraki.organizations.getOrganizations()
-        for o in organizations:
-            if o["id"] in args.organizations or o["name"] in args.organizations:
-                print(f"Analyzing organization {o['name']}")
-
-                # dirty hack: download the changelog to read the subnetPool ranges
-                print(f"Downloading Changelog")
-                changelog = await aiomeraki.change_log.getOrganizationConfigurationChanges(
-                    o["id"], total_pages=-1
-                )
-
-                print("Downloading templates")
-                templates = await aiomeraki.config_templates.getOrganizationConfigTemplates(
-                    o["id"]
-                )
-                if len(templates) == 0:
-                    print("Organization doesn't have any templates defined")
-                    return
-                subnetRanges = []
-                for t in templates:
-                    print(f"Analyzing template {t['name']}")
-                    if "appliance" not in t["productTypes"]:
-                        continue
-                    subnetRanges.extend(get_template_subnet_ranges(t["id"], changelog))
-
-                print("Getting largest supernetworks:")
-                supernetworks = get_supernetworks(subnetRanges)
-                subnetCounter = []
-                for x in supernetworks:
-                    print(x)
-
-                networks = await aiomeraki.networks.getOrganizationNetworks(o["id"])
-                vlan_tasks = []
-                for n in networks:
-                    if not (
-                        "configTemplateId" in n.keys()
-                        and "appliance" in n["productTypes"]
-                    ):
-                        continue
-                    vlan_tasks.append(aiomeraki.vlans.getNetworkVlans(n["id"]))
-
-                print("Downloading VLAN information")
-                for task in asyncio.as_completed(vlan_tasks):
-                    vlans = await task
-                    for v in vlans:
-                        subnet = ipaddress.IPv4Network(v["subnet"])
-                        for superNetwork in supernetworks:
-                            if superNetwork.network.supernet_of(subnet):
-                                superNetwork.usedAddresses += subnet.num_addresses
-                                break
-
-                # print statistics
-                for superNetwork in supernetworks:
-                    smallest_subnet = ipaddress.IPv4Network(
-                        f"{str(superNetwork.network.network_address)}/{superNetwork.mask}"
-                    )
-                    addresses = smallest_subnet.num_addresses
-                    total_subnets = int(superNetwork.network.num_addresses / addresses)
-                    used_subnets = int(superNetwork.usedAddresses / addresses)
-                    free_subnets = total_subnets - used_subnets
-                    print(
-                        f"{superNetwork} subnetworks: total={total_subnets} used={used_subnets} free={free_subnets} -> usage {100*used_subnets/total_subnets}%"
-                    )
+        semaphore = asyncio.Semaphore(args.concurrency)
+        org_tasks = [
+            analyze_organization(aiomeraki, o, semaphore, args.cache_dir)
+            for o in organizations
+            if o["id"] in args.organizations or o["name"] in args.organizations
+        ]
+        ts = int(time.time())
+        rows = []
+        for task in asyncio.as_completed(org_tasks):
+            organization, supernetworks = await task
+            if supernetworks is not None:
+                print_statistics(organization, supernetworks)
+                rows.extend(history_rows(ts, organization, supernetworks))
+
+        if args.history:
+            save_history(args.history, rows)
 
         print("Script complete!")
 
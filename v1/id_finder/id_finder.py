@@ -1,74 +1,462 @@
 import argparse
 import asyncio
+import ipaddress
 import json
 import os
 import re
+import sqlite3
 import sys
+import time
+
+from collections import OrderedDict, deque
+from typing import Dict, List
 
 from meraki.aio import AsyncDashboardAPI
 
+# the fields which are matched against the pattern
+SEARCH_FIELDS = {
+    "o": ("name",),
+    "n": ("name",),
+    "d": ("name",),
+    "c": ("description", "mac", "ip", "ip6"),
+    "b": ("name", "deviceName"),
+}
+
+# the fields which are matched against the networks of a cidr search
+CIDR_SEARCH_FIELDS = {
+    "o": (),
+    "n": (),
+    "d": ("lanIp",),
+    "c": ("ip", "ip6"),
+    "b": (),
+}
+
+# the keys of the different object types inside of a network result
+RESULT_KEYS = {"d": "devices", "c": "clients", "b": "bluetooth_clients"}
+RESULT_TYPES = {"d": "device", "c": "client", "b": "bluetooth_client"}
+
+# the dashboard only returns the clients of the last 31 days and bluetooth clients of the last 7 days
+MAX_CLIENT_TIMESPAN = 31 * 24 * 3600
+MAX_BLUETOOTH_TIMESPAN = 7 * 24 * 3600
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_WORKERS = 16
+
+# characters which make a pattern a real regular expression
+REGEX_CHARACTERS = set(".^$*+?{}[]|()\\")
+
+BACK_REFERENCE = re.compile(r"\\[1-9]|\(\?P=")
+
+# the maximum number of client filters which will be sent to the dashboard per network
+MAX_CLIENT_FILTERS = 8
+
+# characters which can be part of a mac/ipv6 or an ipv4 address
+MAC_CHARACTERS = set("0123456789abcdef:")
+IP_CHARACTERS = set("0123456789.")
+
+
+def fill_names(kind: str, record: Dict) -> Dict:
+    """ unnamed objects will use their mac address as name """
+    if kind == "d" and "name" not in record.keys():
+        record["name"] = record["mac"]
+    elif kind == "c" and "description" not in record.keys():
+        record["description"] = record["mac"]
+    elif kind == "b":
+        if "name" not in record.keys():
+            record["name"] = record["mac"]
+        if "deviceName" not in record.keys():
+            record["deviceName"] = record["mac"]
+    return record
+
+
+def search_values(kind: str, record: Dict, fields=SEARCH_FIELDS) -> List[str]:
+    return [record.get(f) for f in fields[kind] if record.get(f)]
+
+
+def matches(pattern, values: List[str]) -> str:
+    """ returns the pattern which matched one of the values """
+    for v in values:
+        hit = pattern.match(v)
+        if hit:
+            return hit
+    return None
+
+
+def literal_pattern(pattern: str) -> str:
+    """ returns the text the pattern matches literally or None for a real regular expression
+
+    escaped characters like "\\." will be treated as literal characters
+    """
+    literal = []
+    escaped = False
+    for c in pattern:
+        if escaped:
+            if c.isalnum():
+                return None  # character classes like \d or back references
+            literal.append(c)
+            escaped = False
+        elif c == "\\":
+            escaped = True
+        elif c in REGEX_CHARACTERS:
+            return None
+        else:
+            literal.append(c)
+    if escaped:
+        return None
+    return "".join(literal)
+
+
+def client_filters(matcher: "PatternMatcher") -> List[Dict]:
+    """ returns the client query filters which can contain the literal patterns.
+
+    The dashboard returns all clients which contain the filter in the given field, which is
+    a superset of the clients we are looking for. Every client is still matched locally.
+    Returns None if the clients have to be downloaded completely.
+    """
+    literals = matcher.literal_values()
+    if literals is None:
+        return None
+    filters = []
+    for literal in literals:
+        filters.append({"description": literal})
+        characters = set(literal.lower())
+        if characters <= MAC_CHARACTERS:
+            filters.append({"mac": literal})
+            filters.append({"ip6": literal})
+        if characters <= IP_CHARACTERS:
+            filters.append({"ip": literal})
+    if not filters or len(filters) > MAX_CLIENT_FILTERS:
+        return None
+    return filters
+
+
+class PatternMatcher:
+    """ matches a value against many patterns at once.
+
+    Literal patterns are looked up in a dictionary by the prefix of the value, all other
+    patterns are combined into a single regular expression. Like re.match, every pattern
+    has to match at the beginning of the value. match returns the pattern which hit.
+    """
+
+    def __init__(self, patterns: List[str]):
+        self.patterns = patterns
+        self.literals = {}
+        self.regexes = []
+        for p in patterns:
+            literal = literal_pattern(p)
+            if literal:
+                self.literals.setdefault(literal, p)
+            else:
+                self.regexes.append(p)
+        self.literal_lengths = sorted({len(x) for x in self.literals})
+
+        # back references can't be combined, because the group numbers would change
+        combinable = [p for p in self.regexes if not BACK_REFERENCE.search(p)]
+        self.compiled = [
+            (re.compile(p), p) for p in self.regexes if BACK_REFERENCE.search(p)
+        ]
+        self.combined = None
+        if combinable:
+            try:
+                self.combined = re.compile(
+                    "|".join(f"(?P<_p{i}>{p})" for i, p in enumerate(combinable))
+                )
+                self.combinable = combinable
+            except re.error:
+                # e.g. the same group name in two patterns
+                self.compiled.extend((re.compile(p), p) for p in combinable)
+
+    search_fields = SEARCH_FIELDS
+
+    @property
+    def pattern(self) -> str:
+        if len(self.patterns) == 1:
+            return self.patterns[0]
+        return f"{len(self.patterns)} patterns"
+
+    def literal_values(self) -> List[str]:
+        """ returns the literals if there are only literal patterns, otherwise None """
+        return None if self.regexes else list(self.literals)
+
+    def match(self, value: str) -> str:
+        for length in self.literal_lengths:
+            if length > len(value):
+                break
+            hit = self.literals.get(value[:length])
+            if hit:
+                return hit
+        if self.combined:
+            m = self.combined.match(value)
+            if m:
+                return self.combinable[int(m.lastgroup[2:])]
+        for regex, p in self.compiled:
+            if regex.match(value):
+                return p
+        return None
+
+
+class CIDRMatcher:
+    """ matches ip addresses against a list of ipv4/ipv6 networks.
+
+    The networks are stored in one dict per prefix length, so a lookup is a longest prefix
+    match with at most one masked dict access per distinct prefix length. match returns
+    the most specific network which contains the address.
+    """
+
+    search_fields = CIDR_SEARCH_FIELDS
+
+    def __init__(self, cidrs: List[str]):
+        self.patterns = cidrs
+        networks = [ipaddress.ip_network(c, strict=False) for c in cidrs]
+        self.prefixes = {4: [], 6: []}
+        for version, bits in ((4, 32), (6, 128)):
+            by_length = {}
+            for n in networks:
+                if n.version == version:
+                    by_length.setdefault(n.prefixlen, {})[int(n.network_address)] = str(n)
+            # the most specific networks first
+            for length in sorted(by_length, reverse=True):
+                netmask = ((1 << length) - 1) << (bits - length)
+                self.prefixes[version].append((netmask, by_length[length]))
+
+    @property
+    def pattern(self) -> str:
+        if len(self.patterns) == 1:
+            return self.patterns[0]
+        return f"{len(self.patterns)} networks"
+
+    def literal_values(self) -> List[str]:
+        return None
+
+    def match(self, value: str) -> str:
+        version, number = parse_address(value)
+        if not version:
+            return None
+        for netmask, networks in self.prefixes[version]:
+            network = networks.get(number & netmask)
+            if network:
+                return network
+        return None
+
+
+def parse_address(value: str):
+    """ returns the ip version and the address as integer or (None, None) """
+    parts = value.split(".")
+    if len(parts) == 4 and all(p.isdigit() and len(p) <= 3 for p in parts):
+        a, b, c, d = (int(p) for p in parts)
+        if a < 256 and b < 256 and c < 256 and d < 256:
+            return 4, (a << 24) | (b << 16) | (c << 8) | d
+        return None, None
+    try:
+        address = ipaddress.ip_address(value)
+    except ValueError:
+        return None, None
+    return address.version, int(address)
+
+
+class RequestScheduler:
+    """ runs the requests of all organizations with a global concurrency limit.
+
+    Every organization has its own queue and the workers take the requests round
+    robin from these queues, so an organization with thousands of networks can't
+    starve the other organizations.
+    """
+
+    def __init__(self, limit: int = DEFAULT_CONCURRENCY):
+        self.limit = limit
+        self.queues = OrderedDict()
+        self.event = asyncio.Event()
+        self.workers = []
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(q) for q in self.queues.values())
+
+    def submit(self, key: str, coro) -> asyncio.Future:
+        """ queues the coroutine under the given key and returns a future with its result """
+        future = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(key, deque()).append((coro, future))
+        self.event.set()
+        return future
+
+    def _next(self):
+        key, queue = next(iter(self.queues.items()))
+        item = queue.popleft()
+        if queue:
+            self.queues.move_to_end(key)
+        else:
+            del self.queues[key]
+        return item
+
+    async def _worker(self):
+        while True:
+            while not self.queues:
+                self.event.clear()
+                await self.event.wait()
+            coro, future = self._next()
+            if future.cancelled():
+                coro.close()
+                continue
+            try:
+                result = await coro
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            else:
+                if not future.cancelled():
+                    future.set_result(result)
+
+    async def __aenter__(self):
+        self.workers = [asyncio.ensure_future(self._worker()) for _ in range(self.limit)]
+        return self
+
+    async def __aexit__(self, *args):
+        for w in self.workers:
+            w.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        for queue in self.queues.values():
+            for coro, future in queue:
+                coro.close()
+                future.cancel()
+        self.queues.clear()
+
+
+def fetch_network_objects(
+    aiomeraki: AsyncDashboardAPI,
+    scheduler: RequestScheduler,
+    organization_id: str,
+    network,
+    options: str,
+    parameters: Dict[str, Dict] = {},
+    devices: List[Dict] = None,
+    filters: List[Dict] = None,
+) -> Dict[str, asyncio.Future]:
+    """ queues the requests for all objects of the network which are part of the options
+
+    devices which were already downloaded for the whole organization can be passed in,
+    so that they won't be requested again. If client filters are given, only the
+    clients matching these filters will be downloaded.
+    """
+    fetches = {}
+    if "d" in options and devices is not None:
+        fetches["d"] = asyncio.get_running_loop().create_future()
+        fetches["d"].set_result(devices)
+    elif "d" in options:
+        fetches["d"] = scheduler.submit(
+            organization_id, aiomeraki.networks.getNetworkDevices(network["id"])
+        )
+    if "c" in options and filters:
+        fetches["c"] = asyncio.ensure_future(
+            fetch_filtered_clients(
+                aiomeraki, scheduler, organization_id, network["id"], filters
+            )
+        )
+    elif "c" in options:
+        fetches["c"] = scheduler.submit(
+            organization_id,
+            aiomeraki.networks.getNetworkClients(
+                network["id"], total_pages="all", **parameters.get("c", {})
+            ),
+        )
+    if "b" in options and "wireless" in network["productTypes"]:
+        fetches["b"] = scheduler.submit(
+            organization_id,
+            aiomeraki.networks.getNetworkBluetoothClients(
+                network["id"], total_pages="all", **parameters.get("b", {})
+            ),
+        )
+    return fetches
+
+
+async def fetch_filtered_clients(
+    aiomeraki: AsyncDashboardAPI,
+    scheduler: RequestScheduler,
+    organization_id: str,
+    network_id: str,
+    filters: List[Dict],
+) -> List[Dict]:
+    """ downloads only the clients which match one of the filters """
+    results = await asyncio.gather(
+        *[
+            scheduler.submit(
+                organization_id,
+                aiomeraki.networks.getNetworkClients(
+                    network_id, total_pages="all", **f
+                ),
+            )
+            for f in filters
+        ]
+    )
+    clients = {}
+    for result in results:
+        for c in result:
+            clients.setdefault(c["id"], c)
+    return list(clients.values())
+
+
+async def get_organization_devices(
+    aiomeraki: AsyncDashboardAPI,
+    scheduler: RequestScheduler,
+    organization_id: str,
+    networks,
+    filtered: bool,
+) -> Dict[str, List[Dict]]:
+    """ downloads the devices of the whole organization at once and groups them by network """
+    parameters = {"networkIds": [n["id"] for n in networks]} if filtered else {}
+    devices = await scheduler.submit(
+        organization_id,
+        aiomeraki.organizations.getOrganizationDevices(
+            organization_id, total_pages="all", **parameters
+        ),
+    )
+    ret = {n["id"]: [] for n in networks}
+    for d in devices:
+        if d.get("networkId") in ret:
+            ret[d["networkId"]].append(d)
+    return ret
+
 
 async def find_in_networks(
-    aiomeraki: AsyncDashboardAPI, network, pattern, options: str
+    aiomeraki: AsyncDashboardAPI,
+    scheduler: RequestScheduler,
+    organization_id: str,
+    network,
+    pattern,
+    options: str,
+    devices: List[Dict] = None,
+    filters: List[Dict] = None,
 ):
     ret = {
         "name": network["name"],
         "id": network["id"],
         "match": False,
+        "name_match": False,
         "devices": [],
         "clients": [],
         "bluetooth_clients": [],
     }
 
-    # these 3 calls could run concurrently
-    if "d" in options:
-        devices = await aiomeraki.networks.getNetworkDevices(network["id"])
-        for d in devices:
-            if "name" not in d.keys():
-                d["name"] = d["mac"]
-            name = d["name"]
-            if name and pattern.match(name):
-                ret["devices"].append(d)
-
-    if "c" in options:
-        clients = await aiomeraki.networks.getNetworkClients(
-            network["id"], total_pages="all"
-        )
-        for c in clients:
-            if "description" not in c.keys():
-                c["description"] = c["mac"]
-            description = c["description"]
-            mac = c["mac"]
-            ip = c["ip"]
-            ip6 = c["ip6"]
-            if (
-                (description and pattern.match(description))
-                or (mac and pattern.match(mac))
-                or (ip and pattern.match(ip))
-                or (ip6 and pattern.match(ip6))
-            ):
-                ret["clients"].append(c)
-
-    if "b" in options and "wireless" in network["productTypes"]:
-        bluetooth_clients = await aiomeraki.networks.getNetworkBluetoothClients(
-            network["id"], total_pages="all"
-        )
-        for b in bluetooth_clients:
-            if "name" not in b.keys():
-                b["name"] = b["mac"]
-            if "deviceName" not in b.keys():
-                b["deviceName"] = b["mac"]
-
-            name = b["name"]
-            deviceName = b["deviceName"]
-
-            if (name and pattern.match(name)) or (
-                deviceName and pattern.match(deviceName)
-            ):
-                ret["bluetooth_clients"].append(b)
+    fetches = fetch_network_objects(
+        aiomeraki,
+        scheduler,
+        organization_id,
+        network,
+        options,
+        devices=devices,
+        filters=filters,
+    )
+    results = await asyncio.gather(*fetches.values())
+    for kind, records in zip(fetches.keys(), results):
+        for r in records:
+            fill_names(kind, r)
+            hit = matches(pattern, search_values(kind, r, pattern.search_fields))
+            if hit:
+                r["pattern"] = hit
+                ret[RESULT_KEYS[kind]].append(r)
 
+    ret["name_match"] = pattern.match(network["name"]) if "n" in options else None
     if (
-        ("n" in options and pattern.match(network["name"]))
+        ret["name_match"]
         or ret["clients"]
         or ret["devices"]
         or ret["bluetooth_clients"]
@@ -78,11 +466,361 @@ async def find_in_networks(
     return ret
 
 
-async def find_in_organization(
-    aiomeraki: AsyncDashboardAPI, organization, pattern, filter_networks, options: str
+class CheckpointError(Exception):
+    pass
+
+
+class Checkpoint:
+    """ appends every finished (organization, network) work item to a json lines file.
+
+    With resume, the finished work items and their matches are loaded from the file,
+    so that an interrupted search can continue where it stopped.
+    """
+
+    def __init__(self, path: str, search: Dict, resume: bool = False):
+        self.done = set()
+        self.results = {}
+        if resume and os.path.exists(path):
+            lines = self.read_lines(path)
+            if lines and lines[0].get("search") != search:
+                raise CheckpointError(
+                    f"The checkpoint {path} was created for a different search"
+                )
+            for line in lines[1:]:
+                self.done.add((line["organization"], line["network"]))
+                if line.get("result"):
+                    self.results.setdefault(line["organization"], []).append(
+                        line["result"]
+                    )
+            self.file = open(path, "a")
+            if not lines:
+                self.write_line({"search": search})
+        else:
+            # never throw away the work of an earlier search
+            if os.path.exists(path):
+                raise CheckpointError(
+                    f"The checkpoint {path} already exists - use --resume to continue the search or delete it"
+                )
+            self.file = open(path, "w")
+            self.write_line({"search": search})
+
+    @staticmethod
+    def read_lines(path: str) -> List[Dict]:
+        """ reads all lines of the checkpoint.
+
+        An interrupted write can leave a partial last line, which is removed from the file,
+        so that the next lines are appended after the last complete line.
+        """
+        lines = []
+        with open(path, "rb+") as f:
+            raw_lines = f.readlines()
+            end = 0
+            for i, raw in enumerate(raw_lines):
+                try:
+                    if raw.strip():
+                        lines.append(json.loads(raw))
+                except ValueError:
+                    if i < len(raw_lines) - 1:
+                        raise CheckpointError(
+                            f"The checkpoint {path} is corrupt in line {i + 1}"
+                        )
+                    f.truncate(end)
+                    break
+                end += len(raw)
+            else:
+                if raw_lines and not raw_lines[-1].endswith(b"\n"):
+                    f.write(b"\n")
+        return lines
+
+    def write_line(self, js: Dict):
+        self.file.write(json.dumps(js) + "\n")
+        self.file.flush()
+
+    def is_done(self, organization_id: str, network_id: str) -> bool:
+        return (organization_id, network_id) in self.done
+
+    def write(self, organization_id: str, network_id: str, result: Dict):
+        line = {"organization": organization_id, "network": network_id}
+        if result["match"]:
+            line["result"] = result
+        self.write_line(line)
+
+    def close(self):
+        self.file.close()
+
+
+class OrganizationSearch:
+    """ the state of an organization while its networks are searched by the workers """
+
+    def __init__(self, organization, name_match):
+        self.organization = organization
+        self.result = {
+            "name": organization["name"],
+            "id": organization["id"],
+            "match": False,
+            "name_match": name_match,
+            "networks": [],
+        }
+        self.pending = 0
+        self.enumerated = False
+
+    @property
+    def finished(self) -> bool:
+        return self.enumerated and self.pending == 0
+
+
+async def search_organizations(
+    aiomeraki: AsyncDashboardAPI,
+    scheduler: RequestScheduler,
+    organizations,
+    pattern,
+    filter_networks,
+    options: str,
+    workers: int = DEFAULT_WORKERS,
+    filters: List[Dict] = None,
+    checkpoint: Checkpoint = None,
+    on_network=None,
+    on_organization=None,
+):
+    """ searches all networks of the organizations with a bounded pool of workers.
+
+    Every network is one work item in a bounded queue, so the number of tasks and buffered
+    responses doesn't grow with the size of the organizations.
+    If on_network is given, it will be called with every matching network as soon as
+    the network is finished. These networks won't be part of the organization result.
+    on_organization will be called with the result of an organization as soon as all
+    of its networks are finished.
+    filters are the client filters which will be sent to the dashboard.
+    """
+    queue = asyncio.Queue(maxsize=workers * 2)
+    enumerating = asyncio.Semaphore(workers)
+
+    def network_finished(state: OrganizationSearch, result):
+        if not result["match"]:
+            return
+        state.result["match"] = True
+        if on_network:
+            on_network(state.organization, result)
+        else:
+            state.result["networks"].append(result)
+
+    def organization_finished(state: OrganizationSearch):
+        if state.result["name_match"]:
+            state.result["match"] = True
+        if on_organization:
+            on_organization(state.result)
+
+    async def enqueue(organization):
+        async with enumerating:
+            networks = await scheduler.submit(
+                organization["id"],
+                aiomeraki.organizations.getOrganizationNetworks(
+                    organization["id"], total_pages="all"
+                ),
+            )
+            network_options = options
+            if filter_networks:
+                networks = [
+                    n
+                    for n in networks
+                    if n["id"] in filter_networks or n["name"] in filter_networks
+                ]
+                network_options = options.replace("n", "")
+
+            state = OrganizationSearch(
+                organization,
+                pattern.match(organization["name"]) if "o" in options else None,
+            )
+            if checkpoint:
+                for result in checkpoint.results.pop(organization["id"], []):
+                    network_finished(state, result)
+                networks = [
+                    n
+                    for n in networks
+                    if not checkpoint.is_done(organization["id"], n["id"])
+                ]
+
+            devices = {}
+            if "d" in options and networks:
+                devices = await get_organization_devices(
+                    aiomeraki,
+                    scheduler,
+                    organization["id"],
+                    networks,
+                    bool(filter_networks),
+                )
+            for n in networks:
+                state.pending += 1
+                await queue.put((state, n, devices.pop(n["id"], None), network_options))
+            state.enumerated = True
+            if state.finished:
+                organization_finished(state)
+
+    async def enqueue_all():
+        await asyncio.gather(*[enqueue(o) for o in organizations])
+        for _ in range(workers):
+            await queue.put(None)
+
+    async def worker():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            state, network, devices, network_options = item
+            result = await find_in_networks(
+                aiomeraki,
+                scheduler,
+                state.organization["id"],
+                network,
+                pattern,
+                network_options,
+                devices,
+                filters,
+            )
+            if checkpoint:
+                checkpoint.write(state.organization["id"], network["id"], result)
+            network_finished(state, result)
+            state.pending -= 1
+            if state.finished:
+                organization_finished(state)
+
+    await asyncio.gather(enqueue_all(), *[worker() for _ in range(workers)])
+
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    pk INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    id TEXT NOT NULL,
+    organization_id TEXT NOT NULL,
+    network_id TEXT NOT NULL,
+    text TEXT NOT NULL,
+    data TEXT NOT NULL,
+    UNIQUE (kind, id, network_id)
+);
+CREATE INDEX IF NOT EXISTS objects_organization ON objects (organization_id, kind);
+CREATE INDEX IF NOT EXISTS objects_network ON objects (network_id, kind);
+CREATE INDEX IF NOT EXISTS objects_kind ON objects (kind);
+CREATE VIRTUAL TABLE IF NOT EXISTS objects_fts USING fts5(
+    text, content='objects', content_rowid='pk', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS objects_ai AFTER INSERT ON objects BEGIN
+    INSERT INTO objects_fts(rowid, text) VALUES (new.pk, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS objects_ad AFTER DELETE ON objects BEGIN
+    INSERT INTO objects_fts(objects_fts, rowid, text) VALUES ('delete', old.pk, old.text);
+END;
+CREATE TRIGGER IF NOT EXISTS objects_au AFTER UPDATE ON objects BEGIN
+    INSERT INTO objects_fts(objects_fts, rowid, text) VALUES ('delete', old.pk, old.text);
+    INSERT INTO objects_fts(rowid, text) VALUES (new.pk, new.text);
+END;
+CREATE TABLE IF NOT EXISTS sync_state (
+    kind TEXT NOT NULL,
+    network_id TEXT NOT NULL,
+    synced_at REAL NOT NULL,
+    PRIMARY KEY (kind, network_id)
+);
+"""
+
+
+def open_index(path: str) -> sqlite3.Connection:
+    db = sqlite3.connect(path)
+    db.executescript(INDEX_SCHEMA)
+    return db
+
+
+def store_object(
+    db: sqlite3.Connection,
+    kind: str,
+    record: Dict,
+    organization_id: str,
+    network_id: str = "",
 ):
-    networks = await aiomeraki.organizations.getOrganizationNetworks(
-        organization["id"], total_pages="all"
+    fill_names(kind, record)
+    db.execute(
+        """INSERT INTO objects (kind, id, organization_id, network_id, text, data)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (kind, id, network_id) DO UPDATE SET
+        organization_id=excluded.organization_id, text=excluded.text, data=excluded.data""",
+        (
+            kind,
+            record["id"] if kind != "d" else record["serial"],
+            organization_id,
+            network_id,
+            "\n".join(search_values(kind, record)),
+            json.dumps(record),
+        ),
+    )
+
+
+def get_sync_timespan(
+    db: sqlite3.Connection, kind: str, network_id: str, max_timespan: int
+) -> Dict:
+    """ returns the timespan parameter to download only the clients seen since the last sync """
+    row = db.execute(
+        "SELECT synced_at FROM sync_state WHERE kind=? AND network_id=?",
+        (kind, network_id),
+    ).fetchone()
+    if not row:
+        return {}
+    # add some slack, so that we don't miss clients which were seen during the last sync
+    timespan = int(time.time() - row[0]) + 3600
+    return {"timespan": min(timespan, max_timespan)}
+
+
+def set_synced(db: sqlite3.Connection, kind: str, network_id: str, synced_at: float):
+    db.execute(
+        "INSERT OR REPLACE INTO sync_state (kind, network_id, synced_at) VALUES (?, ?, ?)",
+        (kind, network_id, synced_at),
+    )
+
+
+async def sync_network(
+    aiomeraki: AsyncDashboardAPI,
+    scheduler: RequestScheduler,
+    db: sqlite3.Connection,
+    organization_id,
+    network,
+    options: str,
+    devices: List[Dict] = None,
+):
+    started = time.time()
+    parameters = {
+        "c": get_sync_timespan(db, "c", network["id"], MAX_CLIENT_TIMESPAN),
+        "b": get_sync_timespan(db, "b", network["id"], MAX_BLUETOOTH_TIMESPAN),
+    }
+    fetches = fetch_network_objects(
+        aiomeraki, scheduler, organization_id, network, options, parameters, devices
+    )
+    results = await asyncio.gather(*fetches.values())
+    for kind, records in zip(fetches.keys(), results):
+        if kind == "d":
+            # devices are always downloaded completely, so removed devices can be dropped
+            db.execute(
+                "DELETE FROM objects WHERE kind='d' AND network_id=?", (network["id"],)
+            )
+        for r in records:
+            store_object(db, kind, r, organization_id, network["id"])
+        if kind != "d":
+            set_synced(db, kind, network["id"], started)
+
+    db.commit()
+
+
+async def sync_organization(
+    aiomeraki: AsyncDashboardAPI,
+    scheduler: RequestScheduler,
+    db: sqlite3.Connection,
+    organization,
+    filter_networks,
+    options: str,
+):
+    store_object(db, "o", organization, organization["id"])
+    networks = await scheduler.submit(
+        organization["id"],
+        aiomeraki.organizations.getOrganizationNetworks(
+            organization["id"], total_pages="all"
+        ),
     )
     if filter_networks:
         networks = [
@@ -90,27 +828,253 @@ async def find_in_organization(
             for n in networks
             if n["id"] in filter_networks or n["name"] in filter_networks
         ]
-        options = options.replace("n", "")
-    network_tasks = [find_in_networks(aiomeraki, o, pattern, options) for o in networks]
+    else:
+        # drop the networks which don't exist anymore
+        known = db.execute(
+            "SELECT id FROM objects WHERE kind='n' AND organization_id=?",
+            (organization["id"],),
+        ).fetchall()
+        existing = {n["id"] for n in networks}
+        for (network_id,) in known:
+            if network_id not in existing:
+                db.execute(
+                    "DELETE FROM objects WHERE network_id=? OR (kind='n' AND id=?)",
+                    (network_id, network_id),
+                )
+                db.execute("DELETE FROM sync_state WHERE network_id=?", (network_id,))
 
-    ret = {
-        "name": organization["name"],
-        "id": organization["id"],
-        "match": False,
-        "networks": [],
-    }
+    for n in networks:
+        store_object(db, "n", n, organization["id"])
+    db.commit()
 
+    devices = {}
+    if "d" in options and networks:
+        devices = await get_organization_devices(
+            aiomeraki, scheduler, organization["id"], networks, bool(filter_networks)
+        )
+    network_tasks = [
+        sync_network(
+            aiomeraki,
+            scheduler,
+            db,
+            organization["id"],
+            n,
+            options,
+            devices.pop(n["id"], None),
+        )
+        for n in networks
+    ]
     for task in asyncio.as_completed(network_tasks):
-        result = await task
-        if result["match"]:
-            ret["networks"].append(result)
+        await task
 
-    if ("o" in options and pattern.match(organization["name"])) or ret["networks"]:
-        ret["match"] = True
 
+def search_index(
+    db: sqlite3.Connection,
+    pattern,
+    options: str,
+    filter_organizations=None,
+    filter_networks=None,
+) -> List[Dict]:
+    """ searches the local index and returns the results like search_organizations """
+    organizations = {}
+    for (data,) in db.execute("SELECT data FROM objects WHERE kind='o'"):
+        o = json.loads(data)
+        if filter_organizations and not (
+            o["id"] in filter_organizations or o["name"] in filter_organizations
+        ):
+            continue
+        organizations[o["id"]] = {
+            "name": o["name"],
+            "id": o["id"],
+            "match": False,
+            "name_match": None,
+            "networks": {},
+        }
+
+    networks = {}
+    for organization_id, data in db.execute(
+        "SELECT organization_id, data FROM objects WHERE kind='n'"
+    ):
+        n = json.loads(data)
+        if organization_id not in organizations:
+            continue
+        if filter_networks and not (
+            n["id"] in filter_networks or n["name"] in filter_networks
+        ):
+            continue
+        networks[n["id"]] = {
+            "name": n["name"],
+            "id": n["id"],
+            "organization_id": organization_id,
+            "match": False,
+            "name_match": None,
+            "devices": [],
+            "clients": [],
+            "bluetooth_clients": [],
+        }
+
+    kinds = [k for k in SEARCH_FIELDS if k in options]
+    if not kinds:
+        return []
+    # only the searched values are read, the json data is loaded for the hits only
+    if pattern.search_fields is SEARCH_FIELDS:
+        fields = []
+        columns = "text"
+    else:
+        fields = sorted({f for k in kinds for f in pattern.search_fields[k]})
+        columns = ", ".join(f"json_extract(data, '$.{f}')" for f in fields) or "NULL"
+    query = f"SELECT pk, kind, id, network_id, {columns} FROM objects WHERE kind IN ({', '.join('?' * len(kinds))})"
+    parameters = tuple(kinds)
+    literals = pattern.literal_values()
+    if literals and all(len(x) >= 3 for x in literals):
+        # the trigram index returns all objects which contain one of the literals
+        query += " AND pk IN (SELECT rowid FROM objects_fts WHERE objects_fts MATCH ?)"
+        parameters += (
+            " OR ".join('"' + x.replace('"', '""') + '"' for x in literals),
+        )
+
+    for pk, kind, id, network_id, *row in db.execute(query, parameters):
+        if kind == "o":
+            if id not in organizations:
+                continue
+        elif kind == "n":
+            if id not in networks:
+                continue
+        elif network_id not in networks:
+            continue
+        if fields:
+            row = dict(zip(fields, row))
+            values = search_values(kind, row, pattern.search_fields)
+        else:
+            values = row[0].split("\n")
+        hit = matches(pattern, values)
+        if not hit:
+            continue
+        if kind == "o":
+            organizations[id]["name_match"] = hit
+        elif kind == "n":
+            networks[id]["name_match"] = hit
+        else:
+            (data,) = db.execute("SELECT data FROM objects WHERE pk=?", (pk,)).fetchone()
+            record = json.loads(data)
+            record["pattern"] = hit
+            networks[network_id][RESULT_KEYS[kind]].append(record)
+
+    for n in networks.values():
+        if n["name_match"] or n["devices"] or n["clients"] or n["bluetooth_clients"]:
+            n["match"] = True
+            organizations[n["organization_id"]]["networks"][n["id"]] = n
+
+    ret = []
+    for o in organizations.values():
+        o["networks"] = list(o["networks"].values())
+        if o["name_match"] or o["networks"]:
+            o["match"] = True
+            ret.append(o)
     return ret
 
 
+class NDJSONWriter:
+    """ writes every match as one json line, as soon as it was found """
+
+    def __init__(self, path: str):
+        self.file = sys.stdout if path == "-" else open(path, "w")
+
+    def write(self, js: Dict):
+        self.file.write(json.dumps(js) + "\n")
+        self.file.flush()
+
+    def write_organization(self, organization):
+        if organization["name_match"]:
+            self.write(
+                {
+                    "type": "organization",
+                    "pattern": organization["name_match"],
+                    "organization": {
+                        "id": organization["id"],
+                        "name": organization["name"],
+                    },
+                }
+            )
+
+    def write_network(self, organization, network):
+        header = {
+            "organization": {"id": organization["id"], "name": organization["name"]},
+            "network": {"id": network["id"], "name": network["name"]},
+        }
+        if network["name_match"]:
+            self.write(
+                {"type": "network", "pattern": network["name_match"], **header}
+            )
+        for kind in ("d", "c", "b"):
+            for record in network[RESULT_KEYS[kind]]:
+                self.write(
+                    {
+                        "type": RESULT_TYPES[kind],
+                        "pattern": record["pattern"],
+                        **header,
+                        "record": record,
+                    }
+                )
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+
+
+def output_index_search(
+    db: sqlite3.Connection,
+    pattern,
+    options: str,
+    filter_organizations,
+    filter_networks,
+    writer: NDJSONWriter = None,
+):
+    if filter_organizations:
+        options = options.replace("o", "")
+    if filter_networks:
+        options = options.replace("n", "")
+    for result in search_index(
+        db, pattern, options, filter_organizations, filter_networks
+    ):
+        if writer:
+            writer.write_organization(result)
+            for n in result["networks"]:
+                writer.write_network(result, n)
+        else:
+            print_organization(result, len(pattern.patterns) > 1)
+
+
+def print_organization(result, show_pattern: bool = False):
+    def hit(js, key="pattern"):
+        return f" [{js[key]}]" if show_pattern and js[key] else ""
+
+    print(
+        f"Organization \"{result['name']}\" - {result['id']}{hit(result, 'name_match')}"
+    )
+    for n in result["networks"]:
+        print(f"\t\tNetwork \"{n['name']}\" - {n['id']}{hit(n, 'name_match')}")
+
+        if n["devices"]:
+            print(f"\t\tDevices: <Name> - <Serial>")
+            for d in n["devices"]:
+                print(f"\t\t\t\"{d['name']}\" - {d['serial']}{hit(d)}")
+
+        if n["clients"]:
+            print(f"\t\tClients: <Description> - <ID> - <MAC> - <IP> - <IPv6>")
+            for d in n["clients"]:
+                print(
+                    f"\t\t\t\"{d['description']}\" - {d['id']} - {d['mac']} - {d['ip']} - {d['ip6']}{hit(d)}"
+                )
+
+        if n["bluetooth_clients"]:
+            print(f"\t\tBluetooth Clients: <DeviceName> - <Name> - <ID> - <MAC>")
+            for d in n["bluetooth_clients"]:
+                print(
+                    f"\t\t\t\"{d['deviceName']}\" - \"{d['name']}\" - {d['id']} - {d['mac']}{hit(d)}"
+                )
+
+
 async def main():
 
     parser = argparse.ArgumentParser(
@@ -122,10 +1086,36 @@ async def main():
         "--pattern",
         type=str,
         dest="pattern",
-        required=True,
+        required=False,
         help="the regular expression to search for",
     )
 
+    parser.add_argument(
+        "-f",
+        "--pattern-file",
+        type=str,
+        dest="pattern_file",
+        required=False,
+        help="a file with one regular expression per line. All patterns are searched at once",
+    )
+
+    parser.add_argument(
+        "--cidr",
+        type=str,
+        dest="cidrs",
+        nargs="+",
+        required=False,
+        help="search for devices (lan ip) and clients (ip/ipv6) with an address inside of the given ipv4/ipv6 networks instead of a pattern",
+    )
+
+    parser.add_argument(
+        "--cidr-file",
+        type=str,
+        dest="cidr_file",
+        required=False,
+        help="a file with one network per line for the --cidr search",
+    )
+
     parser.add_argument(
         "-s",
         "--search_options",
@@ -156,6 +1146,64 @@ async def main():
         help="the name/id of the networks under which you want to limit the search. This makes the n option of -s obsolete.",
     )
 
+    parser.add_argument(
+        "--index",
+        type=str,
+        dest="index",
+        required=False,
+        help="the path to a local index database. If given, the search will use the index instead of the dashboard",
+    )
+
+    parser.add_argument(
+        "--sync",
+        dest="sync",
+        action="store_true",
+        help="download the objects of the -s options into the index before searching. Clients will be updated incrementally",
+    )
+
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        dest="concurrency",
+        default=DEFAULT_CONCURRENCY,
+        required=False,
+        help="the maximum number of concurrent requests over all organizations",
+    )
+
+    parser.add_argument(
+        "--ndjson",
+        type=str,
+        dest="ndjson",
+        nargs="?",
+        const="-",
+        required=False,
+        help="write every match as one json line into the given file (or stdout if no file is given) as soon as it was found",
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        dest="workers",
+        default=DEFAULT_WORKERS,
+        required=False,
+        help="the number of networks which are searched at the same time",
+    )
+
+    parser.add_argument(
+        "--checkpoint",
+        type=str,
+        dest="checkpoint",
+        required=False,
+        help="a file to store every searched network and its matches",
+    )
+
+    parser.add_argument(
+        "--resume",
+        dest="resume",
+        action="store_true",
+        help="skip all networks which were already searched according to the --checkpoint file",
+    )
+
     try:
         args = parser.parse_args()
     except SystemExit:
@@ -165,8 +1213,71 @@ async def main():
         parser.print_help()
         return
 
-    pattern = re.compile(args.pattern)
+    patterns = [args.pattern] if args.pattern else []
+    if args.pattern_file:
+        with open(args.pattern_file, "r") as f:
+            patterns.extend(x.strip() for x in f if x.strip())
+
+    cidrs = list(args.cidrs) if args.cidrs else []
+    if args.cidr_file:
+        with open(args.cidr_file, "r") as f:
+            cidrs.extend(x.strip() for x in f if x.strip())
+
+    if patterns and cidrs:
+        print("You can either search for a pattern or for networks")
+        parser.print_help()
+        return
+    if not patterns and not cidrs and not args.sync:
+        print("You have to provide a pattern")
+        parser.print_help()
+        return
+    if args.resume and not args.checkpoint:
+        print("--resume needs a --checkpoint")
+        parser.print_help()
+        return
+    if args.sync and not args.index:
+        print("--sync needs an --index")
+        parser.print_help()
+        return
+
+    try:
+        if cidrs:
+            pattern = CIDRMatcher(cidrs)
+        else:
+            pattern = PatternMatcher(patterns) if patterns else None
+    except ValueError as e:
+        print(f"Invalid network: {e}")
+        return
     options = args.options.lower()
+    if cidrs:
+        # only devices and clients have ip addresses
+        options = "".join(x for x in options if CIDR_SEARCH_FIELDS.get(x))
+        if not options:
+            print("The network search needs the d and/or c option of -s")
+            return
+
+    writer = NDJSONWriter(args.ndjson) if args.ndjson else None
+    # keep stdout clean for the json lines
+    info = print if args.ndjson != "-" else lambda *a: print(*a, file=sys.stderr)
+
+    try:
+        await search(args, pattern, options, writer, info)
+    except CheckpointError as e:
+        print(e)
+    finally:
+        if writer:
+            writer.close()
+
+
+async def search(args, pattern, options: str, writer: NDJSONWriter, info):
+    db = open_index(args.index) if args.index else None
+    if db and not args.sync:
+        info(f"Searching for pattern {pattern.pattern} in {args.index}")
+        output_index_search(
+            db, pattern, options, args.organization, args.networks, writer
+        )
+        info("Script complete!")
+        return
 
     # Instantiate a Meraki dashboard API session
     # NOTE: you have to use "async with" so that the session will be closed correctly at the end of the usage
@@ -176,10 +1287,9 @@ async def main():
         log_file_prefix=__file__[:-3],
         print_console=False,
         maximum_retries=5,
-    ) as aiomeraki:
+        maximum_concurrent_requests=args.concurrency,
+    ) as aiomeraki, RequestScheduler(args.concurrency) as scheduler:
         # Get list of organizations to which API key has access
-
-        print(f"Searching for pattern {args.pattern}")
         organizations = await aiomeraki.organizations.getOrganizations()
         if args.organization:
             organizations = [
@@ -187,49 +1297,80 @@ async def main():
                 for o in organizations
                 if o["id"] in args.organization or o["name"] in args.organization
             ]
+
+        if db:
+            info(f"Synchronizing {args.index}")
+            sync_tasks = [
+                sync_organization(aiomeraki, scheduler, db, o, args.networks, options)
+                for o in organizations
+            ]
+            counter = 1
+            for task in asyncio.as_completed(sync_tasks):
+                await task
+                info(
+                    f"Synchronized {counter} of {len(sync_tasks)} Organizations ({scheduler.queue_depth} requests queued)"
+                )
+                counter = counter + 1
+
+            if pattern:
+                info(f"Searching for pattern {pattern.pattern} in {args.index}")
+                output_index_search(
+                    db, pattern, options, args.organization, args.networks, writer
+                )
+            info("Script complete!")
+            return
+
+        info(f"Searching for pattern {pattern.pattern}")
+        # literal patterns are sent to the dashboard, so that only matching clients are downloaded
+        filters = client_filters(pattern)
+        if args.organization:
             options = options.replace("o", "")
 
-        organization_tasks = [
-            find_in_organization(aiomeraki, o, pattern, args.networks, options)
-            for o in organizations
-        ]
-        counter = 1
-        task_count = len(organization_tasks)
-
-        for task in asyncio.as_completed(organization_tasks):
-            result = await task
-            if result["match"]:
-                print(f"Organization \"{result['name']}\" - {result['id']}")
-                for n in result["networks"]:
-                    print(f"\t\tNetwork \"{n['name']}\" - {n['id']}")
-
-                    if n["devices"]:
-                        print(f"\t\tDevices: <Name> - <Serial>")
-                        for d in n["devices"]:
-                            print(f"\t\t\t\"{d['name']}\" - {d['serial']}")
-
-                    if n["clients"]:
-                        print(
-                            f"\t\tClients: <Description> - <ID> - <MAC> - <IP> - <IPv6>"
-                        )
-                        for d in n["clients"]:
-                            print(
-                                f"\t\t\t\"{d['description']}\" - {d['id']} - {d['mac']} - {d['ip']} - {d['ip6']}"
-                            )
-
-                    if n["bluetooth_clients"]:
-                        print(
-                            f"\t\tBluetooth Clients: <DeviceName> - <Name> - <ID> - <MAC>"
-                        )
-                        for d in n["bluetooth_clients"]:
-                            print(
-                                f"\t\t\t\"{d['deviceName']}\" - \"{d['name']}\" - {d['id']} - {d['mac']}"
-                            )
+        checkpoint = None
+        if args.checkpoint:
+            checkpoint = Checkpoint(
+                args.checkpoint,
+                {
+                    "patterns": pattern.patterns,
+                    "options": options,
+                    "organizations": args.organization,
+                    "networks": args.networks,
+                },
+                args.resume,
+            )
+
+        finished = []
+
+        def organization_finished(result):
+            if writer:
+                writer.write_organization(result)
+            elif result["match"]:
+                print_organization(result, len(pattern.patterns) > 1)
+
+            finished.append(result["id"])
+            info(
+                f"Finished {len(finished)} of {len(organizations)} Organizations ({scheduler.queue_depth} requests queued)"
+            )
 
-            print(f"Finished {counter} of {task_count} Organizations")
-            counter = counter + 1
+        try:
+            await search_organizations(
+                aiomeraki,
+                scheduler,
+                organizations,
+                pattern,
+                args.networks,
+                options,
+                args.workers,
+                filters,
+                checkpoint,
+                writer.write_network if writer else None,
+                organization_finished,
+            )
+        finally:
+            if checkpoint:
+                checkpoint.close()
 
-        print("Script complete!")
+        info("Script complete!")
 
 
 if __name__ == "__main__":
@@ -1,18 +1,32 @@
 import argparse
 import asyncio
+import ipaddress
 import json
 import os
 import sys
 import secrets
 import string
 import logging
+import time
 
-from typing import List, Dict
+from datetime import datetime
+from typing import List, Dict, Optional
 
 from meraki.aio import AsyncDashboardAPI
+from meraki.exceptions import AsyncAPIError
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_CONCURRENCY = 8
+
+# none: send the subnets as they are
+# exact: deduplicate and merge adjacent subnets without covering any additional address
+# summarize: replace the subnets inside of every /summary_prefixlen by their smallest supernet
+AGGREGATION_MODES = ("none", "exact", "summarize")
+DEFAULT_SUMMARY_PREFIXLEN = 16
+
+DEFAULT_SNAPSHOT_MAX_AGE = 24  # hours
+
 
 class VPNNetwork:
     def __init__(self, fqdn: str, publicIP: str, networks: List[str]):
@@ -20,6 +34,13 @@ class VPNNetwork:
         self.publicIP = publicIP
         self.networks = networks
 
+    def to_dict(self) -> Dict:
+        return {"fqdn": self.fqdn, "publicIP": self.publicIP, "networks": self.networks}
+
+    @classmethod
+    def from_dict(cls, js: Dict) -> "VPNNetwork":
+        return cls(js["fqdn"], js["publicIP"], js["networks"])
+
 
 class VPNOrganization:
     def __init__(
@@ -39,49 +60,205 @@ class NoPSKError(Exception):
     pass
 
 
+async def limited(semaphore: asyncio.Semaphore, coro):
+    """ awaits the given coroutine while holding a slot of the semaphore """
+    async with semaphore:
+        return await coro
+
+
+async def get_vpn_network(
+    aiomeraki: AsyncDashboardAPI,
+    network: Dict,
+    device_statuses: Dict[str, Dict],
+    semaphore: asyncio.Semaphore,
+) -> Optional[VPNNetwork]:
+    """ collects the vpn settings of the appliance in the given network """
+    n_devices = await limited(
+        semaphore, aiomeraki.networks.getNetworkDevices(network["id"])
+    )
+    # there is only one appliance per network, so we can skip the other devices
+    appliance = next((d for d in n_devices if d["model"][0:2] == "MX"), None)
+    if not appliance:
+        return None
+
+    publicIP = device_statuses.get(appliance["serial"], {}).get("publicIp")
+    if not publicIP:
+        logger.warn(f"Skipping {appliance['serial']} - no public IP available")
+
+    mmi, site2siteVPN = await asyncio.gather(
+        limited(
+            semaphore,
+            aiomeraki.devices.getDeviceManagementInterface(appliance["serial"]),
+        ),
+        limited(
+            semaphore,
+            aiomeraki.appliance.getNetworkApplianceVpnSiteToSiteVpn(network["id"]),
+        ),
+    )
+    fqdn = mmi["ddnsHostnames"]["activeDdnsHostname"]
+
+    subnets = [s["localSubnet"] for s in site2siteVPN["subnets"] if s["useVpn"]]
+    if len(subnets) == 0:
+        return None
+    return VPNNetwork(fqdn, publicIP, subnets)
+
+
 async def get_vpn_networks(
-    aiomeraki: AsyncDashboardAPI, organizationID: str, tags: List[str] = []
+    aiomeraki: AsyncDashboardAPI,
+    organizationID: str,
+    tags: List[str] = [],
+    concurrency: int = DEFAULT_CONCURRENCY,
 ) -> List[VPNNetwork]:
 
     task_o_networks = aiomeraki.organizations.getOrganizationNetworks(
-        organizationID, tags=tags, tagsFilterType="withAnyTags"
+        organizationID, tags=tags, tagsFilterType="withAnyTags", total_pages="all"
     )
 
     task_o_devices = aiomeraki.organizations.getOrganizationDevicesStatuses(
-        organizationID
+        organizationID, total_pages="all"
     )
 
     o_networks, o_devices = await asyncio.gather(task_o_networks, task_o_devices)
 
-    ret = []
-    for n in o_networks:
-        n_devices = await aiomeraki.networks.getNetworkDevices(n["id"])
-        for d in n_devices:
-            if d["model"][0:2] != "MX":
-                continue
-            publicIP = None
-            for o_d in o_devices:
-                if o_d["serial"] == d["serial"]:
-                    publicIP = o_d["publicIp"]
-                    break
-            if not publicIP:
-                logger.warn(f"Skipping {d['serial']} - no public IP available")
-            mmi = await aiomeraki.devices.getDeviceManagementInterface(d["serial"])
-            fqdn = mmi["ddnsHostnames"]["activeDdnsHostname"]
+    # index the statuses once instead of scanning them for every appliance
+    device_statuses = {d["serial"]: d for d in o_devices}
 
-            site2siteVPN = await aiomeraki.appliance.getNetworkApplianceVpnSiteToSiteVpn(
-                n["id"]
-            )
+    semaphore = asyncio.Semaphore(concurrency)
+    vpn_networks = await asyncio.gather(
+        *[
+            get_vpn_network(aiomeraki, n, device_statuses, semaphore)
+            for n in o_networks
+        ]
+    )
+    return [n for n in vpn_networks if n]
 
-            subnets = []
-            for s in site2siteVPN["subnets"]:
-                if s["useVpn"]:
-                    subnets.append(s["localSubnet"])
 
-            if len(subnets) > 0:
-                ret.append(VPNNetwork(fqdn, publicIP, subnets))
-            break  # there is only one appliance per network, so we can skip the other devices
+def load_snapshot(path: str) -> Optional[Dict]:
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warn(f"Ignoring snapshot {path}: {e}")
+        return None
+
 
+def save_snapshot(path: str, snapshot: Dict):
+    # write to a temporary file first, so that an aborted run can't corrupt the snapshot
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(snapshot, f)
+    os.replace(tmp_path, path)
+
+
+async def get_changed_networks(
+    aiomeraki: AsyncDashboardAPI, organizationID: str, since: float
+) -> Optional[set]:
+    """ returns the ids of all networks which got changed since the given timestamp
+
+    returns None if the change log isn't available
+    """
+    t0 = datetime.utcfromtimestamp(since).strftime("%Y-%m-%dT%H:%M:%SZ")
+    try:
+        changes = await aiomeraki.organizations.getOrganizationConfigurationChanges(
+            organizationID, t0=t0, total_pages="all"
+        )
+    except AsyncAPIError as e:
+        logger.warn(f"Unable to read the change log of {organizationID}: {e}")
+        return None
+    return {c["networkId"] for c in changes if c.get("networkId")}
+
+
+async def get_vpn_networks_incremental(
+    aiomeraki: AsyncDashboardAPI,
+    organizationID: str,
+    tags: List[str] = [],
+    concurrency: int = DEFAULT_CONCURRENCY,
+    snapshot_dir: str = ".",
+    max_age: float = DEFAULT_SNAPSHOT_MAX_AGE,
+) -> List[VPNNetwork]:
+    """ like get_vpn_networks, but reuses the vpn networks of the last run
+
+    A network will only be downloaded again if it got changed according to the
+    change log, if its appliance got replaced or if the data is older than max_age hours.
+    The public IPs are always taken from the current device statuses.
+    """
+    path = os.path.join(snapshot_dir, f"{organizationID}.json")
+    started = time.time()
+    oldest = started - max_age * 3600
+    snapshot = load_snapshot(path)
+    if snapshot and snapshot["timestamp"] < oldest:
+        snapshot = None
+
+    tasks = [
+        aiomeraki.organizations.getOrganizationNetworks(
+            organizationID, tags=tags, tagsFilterType="withAnyTags", total_pages="all"
+        ),
+        aiomeraki.organizations.getOrganizationDevicesStatuses(
+            organizationID, total_pages="all"
+        ),
+    ]
+    if snapshot:
+        tasks.append(
+            get_changed_networks(aiomeraki, organizationID, snapshot["timestamp"])
+        )
+    o_networks, o_devices, *changed_networks = await asyncio.gather(*tasks)
+    changed_networks = changed_networks[0] if changed_networks else None
+    if changed_networks is None:
+        snapshot = None
+
+    device_statuses = {d["serial"]: d for d in o_devices}
+    appliances = {
+        d["networkId"]: d["serial"]
+        for d in o_devices
+        if d.get("networkId") and d.get("model", "")[0:2] == "MX"
+    }
+    entries = snapshot["networks"] if snapshot else {}
+
+    semaphore = asyncio.Semaphore(concurrency)
+    refresh = []
+    networks = {}
+    for n in o_networks:
+        entry = entries.get(n["id"])
+        if (
+            not entry
+            or entry["fetched"] < oldest
+            or n["id"] in changed_networks
+            or entry["serial"] != appliances.get(n["id"])
+        ):
+            refresh.append(n)
+        else:
+            networks[n["id"]] = entry
+
+    logger.info(
+        f"Organization {organizationID}: reusing {len(networks)} networks, downloading {len(refresh)} networks"
+    )
+    vpn_networks = await asyncio.gather(
+        *[get_vpn_network(aiomeraki, n, device_statuses, semaphore) for n in refresh]
+    )
+    for n, vpn_network in zip(refresh, vpn_networks):
+        networks[n["id"]] = {
+            "fetched": started,
+            "serial": appliances.get(n["id"]),
+            "vpn_network": vpn_network.to_dict() if vpn_network else None,
+        }
+
+    save_snapshot(
+        path,
+        {"organizationID": organizationID, "timestamp": started, "networks": networks},
+    )
+
+    ret = []
+    for n in o_networks:
+        entry = networks[n["id"]]
+        if not entry["vpn_network"]:
+            continue
+        vpn_network = VPNNetwork.from_dict(entry["vpn_network"])
+        status = device_statuses.get(entry["serial"])
+        if status:
+            vpn_network.publicIP = status.get("publicIp")
+        ret.append(vpn_network)
     return ret
 
 
@@ -94,72 +271,389 @@ def prepare_vpn_peer(
     networkTags: List[str],
 ):
     return {
-        "name": name[:32],
+        "name": peer_name(name),
         "publicIp": publicIp,
         "privateSubnets": privateSubnets,
         "secret": secret,
-        "ikeVersion": ikeVersion,
+        # the dashboard returns the ike version as string
+        "ikeVersion": str(ikeVersion),
         "ipsecPoliciesPreset": "default",
         "networkTags": networkTags,
     }
 
 
-async def connect_organization(
-    aiomeraki: AsyncDashboardAPI,
-    org1: VPNOrganization,
-    org2: VPNOrganization,
+def peer_name(fqdn: str) -> str:
+    """ the dashboard only accepts 32 characters for the name of a peer """
+    return fqdn[:32] if fqdn else fqdn
+
+
+def peer_changed(old_peer: Dict, new_peer: Dict) -> bool:
+    """ checks if the new peer would change any field of the existing one """
+    return any(old_peer.get(k) != v for k, v in new_peer.items())
+
+
+class VPNPeerDiff:
+    def __init__(self):
+        self.base = []  # the peers the diff was calculated for
+        self.peers = []
+        self.added = []
+        self.updated = []
+        self.unchanged = []
+
+    @property
+    def changed(self) -> bool:
+        return len(self.added) > 0 or len(self.updated) > 0
+
+    def to_dict(self) -> Dict:
+        return {
+            "base": self.base,
+            "peers": self.peers,
+            "added": self.added,
+            "updated": self.updated,
+            "unchanged": self.unchanged,
+        }
+
+    @classmethod
+    def from_dict(cls, js: Dict) -> "VPNPeerDiff":
+        diff = cls()
+        diff.base = js["base"]
+        diff.peers = js["peers"]
+        diff.added = js["added"]
+        diff.updated = js["updated"]
+        diff.unchanged = js["unchanged"]
+        return diff
+
+    def __str__(self):
+        return f"added={len(self.added)} updated={len(self.updated)} unchanged={len(self.unchanged)}"
+
+
+def diff_vpn_peers(
+    vpn_peers: List[Dict],
+    vpn_networks: List[VPNNetwork],
+    privateSubnets: List[str],
+    networkTags: List[str],
     psk: str = None,
     ike_version: int = None,
-):
-    privateSubnets = []
-    [privateSubnets.extend(x.networks) for x in org2.vpn_networks]
-    new_vpn_peers = []
-    for vpn_peer in org1.vpn_peers:
-        for n2 in org2.vpn_networks:  # check if a peer must be updated
-            if vpn_peer["name"] == n2.fqdn or vpn_peer["publicIp"] == n2.publicIP:
-                vpn_peer["privateSubnets"] = privateSubnets
-                if psk:
-                    vpn_peer["secret"] = psk
-                if ike_version:
-                    vpn_peer["ikeVersion"] = ike_version
-
-                peer = prepare_vpn_peer(
-                    n2.fqdn,
-                    n2.publicIP,
-                    privateSubnets,
-                    vpn_peer["secret"],
-                    vpn_peer["ikeVersion"],
-                    org1.tags if len(org1.tags) > 0 else ["all"],
-                )
-
-                new_vpn_peers.append(peer)
-                break
+) -> VPNPeerDiff:
+    """ calculates the new peer list for the given remote networks
+
+    existing peers are matched by name or publicIp against the remote networks.
+    Both sides are indexed once, so the diff runs in linear time.
+    """
+    # index the remote networks. The first network in the list wins, like in a linear search
+    by_name = {}
+    by_ip = {}
+    for i, n in enumerate(vpn_networks):
+        by_name.setdefault(peer_name(n.fqdn), i)
+        if n.publicIP:
+            by_ip.setdefault(n.publicIP, i)
+
+    diff = VPNPeerDiff()
+    for vpn_peer in vpn_peers:
+        candidates = [
+            i
+            for i in (by_name.get(vpn_peer["name"]), by_ip.get(vpn_peer["publicIp"]))
+            if i is not None
+        ]
+        if not candidates:
+            diff.peers.append(vpn_peer)  # adding existing peers
+            continue
+
+        n2 = vpn_networks[min(candidates)]
+        peer = prepare_vpn_peer(
+            n2.fqdn,
+            n2.publicIP,
+            privateSubnets,
+            psk if psk else vpn_peer["secret"],
+            ike_version if ike_version else vpn_peer["ikeVersion"],
+            networkTags,
+        )
+        if peer_changed(vpn_peer, peer):
+            diff.updated.append(peer["name"])
         else:
-            new_vpn_peers.append(vpn_peer)  # adding existing peers
-            pass
+            diff.unchanged.append(peer["name"])
+            peer = vpn_peer
+        diff.peers.append(peer)
+
     # adding new peers
-    for n2 in org2.vpn_networks:  # check if a peer must be updated
-        for vpn_peer in org1.vpn_peers:
-            if vpn_peer["name"] == n2.fqdn or vpn_peer["publicIp"] == n2.publicIP:
-                break
-        else:
-            if not psk:
-                raise NoPSKError()
-            peer = prepare_vpn_peer(
-                n2.fqdn,
-                n2.publicIP,
-                privateSubnets,
-                psk,
-                ike_version if ike_version else 1,
-                org1.tags if len(org1.tags) > 0 else ["all"],
-            )
-            new_vpn_peers.append(peer)
+    peer_names = {p["name"] for p in vpn_peers}
+    peer_ips = {p["publicIp"] for p in vpn_peers}
+    for n2 in vpn_networks:
+        if peer_name(n2.fqdn) in peer_names or n2.publicIP in peer_ips:
+            continue
+        if not psk:
+            raise NoPSKError()
+        peer = prepare_vpn_peer(
+            n2.fqdn,
+            n2.publicIP,
+            privateSubnets,
+            psk,
+            ike_version if ike_version else 1,
+            networkTags,
+        )
+        diff.added.append(peer["name"])
+        diff.peers.append(peer)
+
+    return diff
+
+
+def collapse_subnets(subnets) -> List:
+    """ deduplicates and merges the given ipv4/ipv6 networks """
+    ret = []
+    for version in (4, 6):
+        ret.extend(
+            ipaddress.collapse_addresses([n for n in subnets if n.version == version])
+        )
+    return ret
+
 
+def covering_supernet(subnets):
+    """ returns the smallest network which contains all given networks of the same version """
+    start = min(int(n.network_address) for n in subnets)
+    end = max(int(n.broadcast_address) for n in subnets)
+    max_prefixlen = subnets[0].max_prefixlen
+    prefixlen = max_prefixlen - (start ^ end).bit_length()
+    return ipaddress.ip_network((start, prefixlen), strict=False)
+
+
+def aggregate_subnets(
+    subnets: List[str],
+    mode: str = "none",
+    summary_prefixlen: int = DEFAULT_SUMMARY_PREFIXLEN,
+    reserved: List[str] = [],
+) -> List[str]:
+    """ aggregates the subnets depending on the given mode (see AGGREGATION_MODES)
+
+    A summary will never be used if it would also cover one of the reserved subnets,
+    which belong to someone else. In that case the exact subnets will be kept.
+    """
+    if mode == "none":
+        return subnets
+
+    collapsed = collapse_subnets(
+        [ipaddress.ip_network(x, strict=False) for x in subnets]
+    )
+    if mode == "exact":
+        return [str(n) for n in collapsed]
+
+    reserved = collapse_subnets(
+        [ipaddress.ip_network(x, strict=False) for x in reserved]
+    )
+    buckets = {}
+    for n in collapsed:
+        key = (
+            n.supernet(new_prefix=summary_prefixlen)
+            if n.prefixlen > summary_prefixlen
+            else n
+        )
+        buckets.setdefault(key, []).append(n)
+
+    ret = []
+    for bucket in buckets.values():
+        summary = covering_supernet(bucket)
+        foreign = [
+            r
+            for r in reserved
+            if r.version == summary.version
+            and r.overlaps(summary)
+            and not any(r.overlaps(n) for n in bucket)
+        ]
+        ret.extend(bucket if foreign else [summary])
+    return [str(n) for n in collapse_subnets(ret)]
+
+
+def get_private_subnets(org: VPNOrganization) -> List[str]:
+    privateSubnets = []
+    [privateSubnets.extend(x.networks) for x in org.vpn_networks]
+    return privateSubnets
+
+
+def plan_organization(
+    org1: VPNOrganization,
+    remote_orgs: List[VPNOrganization],
+    psk: str = None,
+    ike_version: int = None,
+    aggregation: str = "none",
+    summary_prefixlen: int = DEFAULT_SUMMARY_PREFIXLEN,
+) -> VPNPeerDiff:
+    """ calculates the final peer list of org1 for all remote organizations """
+    diff = VPNPeerDiff()
+    diff.base = org1.vpn_peers
+    diff.peers = org1.vpn_peers
+    for org2 in remote_orgs:
+        # the subnets of all other organizations must never be covered by a summary
+        reserved = get_private_subnets(org1)
+        [
+            reserved.extend(get_private_subnets(o))
+            for o in remote_orgs
+            if o.organizationID != org2.organizationID
+        ]
+        remote_diff = diff_vpn_peers(
+            diff.peers,
+            org2.vpn_networks,
+            aggregate_subnets(
+                get_private_subnets(org2), aggregation, summary_prefixlen, reserved
+            ),
+            org1.tags if len(org1.tags) > 0 else ["all"],
+            psk,
+            ike_version,
+        )
+        diff.peers = remote_diff.peers
+        diff.added.extend(remote_diff.added)
+        diff.updated.extend(remote_diff.updated)
+        diff.unchanged.extend(remote_diff.unchanged)
+    return diff
+
+
+async def push_vpn_peers(
+    aiomeraki: AsyncDashboardAPI, organizationID: str, diff: VPNPeerDiff
+):
+    if not diff.changed:
+        logger.info(
+            f"VPN peers of organization {organizationID} are up to date - skipping update"
+        )
+        return
+
+    logger.info(f"Updating VPN peers of organization {organizationID}: {diff}")
     await aiomeraki.appliance.updateOrganizationApplianceVpnThirdPartyVPNPeers(
-        org1.organizationID, new_vpn_peers
+        organizationID, diff.peers
     )
 
 
+async def push_all_vpn_peers(
+    aiomeraki: AsyncDashboardAPI, diffs: Dict[str, VPNPeerDiff]
+) -> bool:
+    """ pushes all peer lists concurrently.
+
+    If one of the updates fails, all successful updates will be rolled back to
+    their original peers, so that the organizations don't end up asymmetric.
+    """
+    organizationIDs = list(diffs.keys())
+    results = await asyncio.gather(
+        *[push_vpn_peers(aiomeraki, o, diffs[o]) for o in organizationIDs],
+        return_exceptions=True,
+    )
+    failed = [o for o, r in zip(organizationIDs, results) if isinstance(r, Exception)]
+    if not failed:
+        return True
+
+    for o, r in zip(organizationIDs, results):
+        if isinstance(r, Exception):
+            logger.error(f"Unable to update the VPN peers of organization {o}: {r}")
+
+    rollback = [o for o in organizationIDs if o not in failed and diffs[o].changed]
+    for o in rollback:
+        logger.warn(f"Rolling back the VPN peers of organization {o}")
+    results = await asyncio.gather(
+        *[
+            aiomeraki.appliance.updateOrganizationApplianceVpnThirdPartyVPNPeers(
+                o, diffs[o].base
+            )
+            for o in rollback
+        ],
+        return_exceptions=True,
+    )
+    for o, r in zip(rollback, results):
+        if isinstance(r, Exception):
+            logger.error(f"Unable to roll back the VPN peers of organization {o}: {r}")
+    return False
+
+
+def plan_mesh(
+    orgs: List[VPNOrganization],
+    psk: str = None,
+    ike_version: int = None,
+    aggregation: str = "none",
+    summary_prefixlen: int = DEFAULT_SUMMARY_PREFIXLEN,
+) -> Dict[str, VPNPeerDiff]:
+    """ calculates the peer lists to connect every organization with all other organizations """
+    diffs = {}
+    for org in orgs:
+        remote_orgs = [o for o in orgs if o.organizationID != org.organizationID]
+        diffs[org.organizationID] = plan_organization(
+            org, remote_orgs, psk, ike_version, aggregation, summary_prefixlen
+        )
+    return diffs
+
+
+def save_plan(path: str, diffs: Dict[str, VPNPeerDiff]):
+    plan = {
+        "created": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "organizations": {k: v.to_dict() for k, v in diffs.items()},
+    }
+    # the plan contains the pre shared keys, so only the owner may read it
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.chmod(path, 0o600)
+    with open(fd, "w") as f:
+        json.dump(plan, f, indent=2)
+
+
+def load_plan(path: str) -> Dict[str, VPNPeerDiff]:
+    with open(path, "r") as f:
+        plan = json.load(f)
+    return {k: VPNPeerDiff.from_dict(v) for k, v in plan["organizations"].items()}
+
+
+async def apply_plan(
+    aiomeraki: AsyncDashboardAPI, diffs: Dict[str, VPNPeerDiff]
+) -> bool:
+    """ pushes a saved plan without collecting the vpn networks again.
+
+    The whole plan will be refused, if the peers of any organization got changed since
+    the plan was created. Otherwise the organizations could end up asymmetric.
+    """
+    push = {}
+    for organizationID, diff in diffs.items():
+        if not diff.changed:
+            logger.info(
+                f"VPN peers of organization {organizationID} are up to date - skipping update"
+            )
+            continue
+        push[organizationID] = diff
+
+    organizationIDs = list(push.keys())
+    current = await asyncio.gather(
+        *[
+            aiomeraki.appliance.getOrganizationApplianceVpnThirdPartyVPNPeers(o)
+            for o in organizationIDs
+        ]
+    )
+    stale = [
+        o for o, peers in zip(organizationIDs, current) if peers["peers"] != push[o].base
+    ]
+    if stale:
+        for o in stale:
+            logger.error(
+                f"VPN peers of organization {o} were changed after the plan was created"
+            )
+        logger.error("Refusing to apply the plan - please create a new plan")
+        return False
+    return await push_all_vpn_peers(aiomeraki, push)
+
+
+async def get_vpn_organization(
+    aiomeraki: AsyncDashboardAPI,
+    organizationID: str,
+    tags: List[str] = [],
+    concurrency: int = DEFAULT_CONCURRENCY,
+    snapshot_dir: str = None,
+    snapshot_max_age: float = DEFAULT_SNAPSHOT_MAX_AGE,
+) -> VPNOrganization:
+    if snapshot_dir:
+        task_networks = get_vpn_networks_incremental(
+            aiomeraki, organizationID, tags, concurrency, snapshot_dir, snapshot_max_age
+        )
+    else:
+        task_networks = get_vpn_networks(aiomeraki, organizationID, tags, concurrency)
+    networks, peers = await asyncio.gather(
+        task_networks,
+        aiomeraki.appliance.getOrganizationApplianceVpnThirdPartyVPNPeers(
+            organizationID
+        ),
+    )
+    return VPNOrganization(organizationID, networks, peers["peers"], tags)
+
+
 async def main():
 
     parser = argparse.ArgumentParser(
@@ -170,7 +664,7 @@ async def main():
         "--organization1",
         type=str,
         dest="organization1",
-        required=True,
+        required=False,
         help="the name/id of the first organization",
     )
     parser.add_argument(
@@ -178,10 +672,31 @@ async def main():
         "--organization2",
         type=str,
         dest="organization2",
-        required=True,
+        required=False,
         help="the name/id of the second organization",
     )
 
+    parser.add_argument(
+        "-m",
+        "--mesh",
+        type=str,
+        dest="mesh",
+        nargs="+",
+        required=False,
+        help="the name/id of the organizations which should be connected in a full mesh. Replaces -o1 and -o2",
+    )
+
+    parser.add_argument(
+        "-t",
+        "--tags",
+        type=str,
+        dest="tags",
+        nargs="+",
+        default=[],
+        required=False,
+        help="the tags from the mesh organizations to grab the vpn networks and remote IPs. Leave Empty for all",
+    )
+
     parser.add_argument(
         "-t1",
         "--tags1",
@@ -221,6 +736,67 @@ async def main():
         help="the IKE version. Must be 1 or 2",
     )
 
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        dest="concurrency",
+        default=DEFAULT_CONCURRENCY,
+        required=False,
+        help=f"the maximum number of concurrent requests while collecting the vpn networks. Default: {DEFAULT_CONCURRENCY}",
+    )
+
+    parser.add_argument(
+        "--aggregate-subnets",
+        type=str,
+        dest="aggregation",
+        choices=AGGREGATION_MODES,
+        default="none",
+        required=False,
+        help="how the remote subnets should be aggregated. exact: remove duplicates and merge adjacent subnets (safe). summarize: replace all subnets inside of a --summary-prefixlen network by their smallest supernet, as long as the supernet doesn't cover a subnet of another organization. Default: none",
+    )
+
+    parser.add_argument(
+        "--summary-prefixlen",
+        type=int,
+        dest="summary_prefixlen",
+        default=DEFAULT_SUMMARY_PREFIXLEN,
+        required=False,
+        help=f"the shortest prefix which will be used by --aggregate-subnets summarize. Default: {DEFAULT_SUMMARY_PREFIXLEN}",
+    )
+
+    parser.add_argument(
+        "--snapshot-dir",
+        type=str,
+        dest="snapshot_dir",
+        required=False,
+        help="a directory to store the vpn networks of every organization. The next run will only download the networks which got changed since then",
+    )
+
+    parser.add_argument(
+        "--snapshot-max-age",
+        type=float,
+        dest="snapshot_max_age",
+        default=DEFAULT_SNAPSHOT_MAX_AGE,
+        required=False,
+        help=f"the maximum age in hours of a network in the snapshot before it will be downloaded again. Default: {DEFAULT_SNAPSHOT_MAX_AGE}",
+    )
+
+    parser.add_argument(
+        "--plan",
+        type=str,
+        dest="plan",
+        required=False,
+        help="only calculate the changes and write them into the given file. The file contains the PSKs in plain text!",
+    )
+
+    parser.add_argument(
+        "--apply",
+        type=str,
+        dest="apply",
+        required=False,
+        help="push the changes of a file created by --plan. No other parameters are needed",
+    )
+
     if len(sys.argv) < 3:
         parser.print_help()
         return
@@ -234,6 +810,24 @@ async def main():
         parser.print_help()
         return
 
+    if args.apply:
+        wanted = []
+    elif args.mesh:
+        if len(args.mesh) < 2:
+            print("A mesh needs at least two organizations")
+            parser.print_help()
+            return
+        wanted = [(x, args.tags) for x in dict.fromkeys(args.mesh)]
+    elif args.organization1 and args.organization2:
+        wanted = [(args.organization1, args.tags1), (args.organization2, args.tags2)]
+    else:
+        print("You have to provide either -o1 and -o2, --mesh or --apply")
+        parser.print_help()
+        return
+
+    if args.snapshot_dir and not os.path.exists(args.snapshot_dir):
+        os.makedirs(args.snapshot_dir)
+
     if args.psk == "random":
         alphabet = string.ascii_letters + string.digits + '_-,.!"§$%&/()='
         args.psk = "".join(secrets.choice(alphabet) for i in range(30))
@@ -246,43 +840,61 @@ async def main():
         log_file_prefix=__file__[:-3],
         print_console=True,
         maximum_retries=5,
+        maximum_concurrent_requests=args.concurrency,
     ) as aiomeraki:
+        if args.apply:
+            logger.info(f"Applying plan {args.apply}")
+            await apply_plan(aiomeraki, load_plan(args.apply))
+            return
+
         # Get list of organizations to which API key has access
         organizations = await aiomeraki.organizations.getOrganizations()
 
+        org_tasks = []
+        for name, tags in wanted:
+            for o in organizations:
+                if o["id"] == name or o["name"] == name:
+                    org_tasks.append(
+                        get_vpn_organization(
+                            aiomeraki,
+                            o["id"],
+                            tags,
+                            args.concurrency,
+                            args.snapshot_dir,
+                            args.snapshot_max_age,
+                        )
+                    )
+                    break
+            else:
+                logger.error(f"Could not find the organization {name}")
+                return
+
         logger.info("Downloading Settings")
-        vpn_orgs = [None, None]
-        for o in organizations:
-            if o["id"] == args.organization1 or o["name"] == args.organization1:
-                networks = await get_vpn_networks(aiomeraki, o["id"], args.tags1)
-
-                peers = await aiomeraki.appliance.getOrganizationApplianceVpnThirdPartyVPNPeers(
-                    o["id"]
-                )
-                org = VPNOrganization(o["id"], networks, peers["peers"], args.tags1)
-                vpn_orgs[0] = org
-            elif o["id"] == args.organization2 or o["name"] == args.organization2:
-                networks = await get_vpn_networks(aiomeraki, o["id"], args.tags2)
-
-                peers = await aiomeraki.appliance.getOrganizationApplianceVpnThirdPartyVPNPeers(
-                    o["id"]
-                )
-                org = VPNOrganization(o["id"], networks, peers["peers"], args.tags2)
-                vpn_orgs[1] = org
-
-        if None in vpn_orgs:
-            logger.error("Could not find the correct organizations")
-            return
+        # every organization is downloaded exactly once
+        vpn_orgs = await asyncio.gather(*org_tasks)
+
         try:
-            logger.info("Updating VPN Settings")
-            await connect_organization(
-                aiomeraki, vpn_orgs[0], vpn_orgs[1], args.psk, args.ike_version
-            )
-            await connect_organization(
-                aiomeraki, vpn_orgs[1], vpn_orgs[0], args.psk, args.ike_version
+            # connecting two organizations is the same as a mesh of two organizations
+            diffs = plan_mesh(
+                vpn_orgs,
+                args.psk,
+                args.ike_version,
+                args.aggregation,
+                args.summary_prefixlen,
             )
         except NoPSKError:
             logger.error("Unable to add new peer. Please specify --psk.")
+            return
+
+        if args.plan:
+            for organizationID, diff in diffs.items():
+                logger.info(f"Planned changes for organization {organizationID}: {diff}")
+            save_plan(args.plan, diffs)
+            logger.info(f"Plan written to {args.plan}")
+            return
+
+        logger.info("Updating VPN Settings")
+        await push_all_vpn_peers(aiomeraki, diffs)
 
 
 if __name__ == "__main__":
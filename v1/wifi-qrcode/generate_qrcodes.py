@@ -1,12 +1,24 @@
 import argparse
 import asyncio
+import hashlib
+import io
 import json
 import os
+import shutil
 import sys
+import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
 import qrcode
+import qrcode.image.svg
 
 import meraki.aio
 
+# part of the hash of every qr code, so that a change of the rendering invalidates the cached images
+RENDER_OPTIONS = {"version": 1}
+
+OUTPUT_MODES = ("png", "svg", "zip", "pdf")
+
 
 def wifi_code(
     ssid: str, hidden: bool, authentication_type: str, password: str = None
@@ -21,11 +33,333 @@ def wifi_code(
         return f"WIFI:T:nopass;S:{ssid};H:{hidden};;"
 
 
+def render_qrcode(code: str, path: str, image_format: str = "png"):
+    """Render the wifi code and save it as png or svg. This runs in a worker process"""
+    if image_format == "svg":
+        # svg paths are written directly, without rasterizing the code
+        img = qrcode.make(code, image_factory=qrcode.image.svg.SvgPathImage)
+    else:
+        img = qrcode.make(code)
+    # write to a temporary file first, so that an aborted run can't leave a partial image
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            img.save(f)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def render_qrcode_png(code: str) -> bytes:
+    """Render the wifi code into png bytes. This runs in a worker process"""
+    buffer = io.BytesIO()
+    qrcode.make(code).save(buffer)
+    return buffer.getvalue()
+
+
+def render_qrcode_bitmap(code: str):
+    """Render the wifi code into a compressed 1 bit bitmap for pdf pages. This runs in a worker process"""
+    image = qrcode.make(code).get_image().convert("1")
+    return image.width, image.height, zlib.compress(image.tobytes())
+
+
+class QRCodeCache:
+    """Content addressed store of the rendered qr codes
+
+    Every code is rendered once into .objects/{hash}.png and linked to its output files.
+    The manifest maps every output file to the hash of its code, so unchanged files are skipped
+    and files which are no longer generated can be removed.
+    """
+
+    def __init__(self, directory: str, image_format: str = "png"):
+        self.directory = directory
+        self.image_format = image_format
+        self.objects = os.path.join(directory, ".objects")
+        self.manifest_path = os.path.join(directory, "manifest.json")
+        self.old_files = {}
+        if os.path.exists(self.manifest_path):
+            try:
+                with open(self.manifest_path, "r") as f:
+                    self.old_files = json.load(f)["files"]
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Ignoring manifest {self.manifest_path}: {e}")
+        self.files = {}
+        self.rendering = {}
+        self.stats = {"rendered": 0, "linked": 0, "unchanged": 0, "removed": 0}
+        os.makedirs(self.objects, exist_ok=True)
+
+    def digest(self, code: str) -> str:
+        return hashlib.sha256(
+            json.dumps(
+                {"code": code, "format": self.image_format, **RENDER_OPTIONS},
+                sort_keys=True,
+            ).encode()
+        ).hexdigest()
+
+    def object_path(self, digest: str, image_format: str = None) -> str:
+        return os.path.join(
+            self.objects, f"{digest}.{image_format or self.image_format}"
+        )
+
+    async def add(
+        self,
+        executor: ProcessPoolExecutor,
+        code: str,
+        network_id: str,
+        network_name: str,
+        ssid: str,
+    ):
+        """Make sure that the file of the network and ssid contains the rendered code"""
+        path = os.path.join(
+            self.directory, f"{network_name}_{ssid}.{self.image_format}"
+        )
+        digest = self.digest(code)
+        entry = {
+            "hash": digest,
+            "format": self.image_format,
+            "network": network_id,
+            "ssid": ssid,
+        }
+        old_entry = self.old_files.get(path)
+        if old_entry and old_entry["hash"] == digest and os.path.exists(path):
+            self.files[path] = entry
+            self.stats["unchanged"] += 1
+            return
+
+        object_path = self.object_path(digest)
+        if digest not in self.rendering:
+            if os.path.exists(object_path):
+                self.rendering[digest] = asyncio.get_running_loop().create_future()
+                self.rendering[digest].set_result(None)
+            else:
+                self.rendering[digest] = asyncio.get_running_loop().run_in_executor(
+                    executor, render_qrcode, code, object_path, self.image_format
+                )
+                self.stats["rendered"] += 1
+        try:
+            await self.rendering[digest]
+        except Exception as e:
+            print(f"Unable to generate {path}: {e}")
+            # keep the old file, it will be rendered again in the next run
+            if old_entry:
+                self.files[path] = old_entry
+            return
+
+        if os.path.exists(path):
+            os.remove(path)
+        try:
+            os.link(object_path, path)
+        except OSError:
+            shutil.copyfile(object_path, path)
+        self.files[path] = entry
+        self.stats["linked"] += 1
+
+    def remove_stale(self, is_stale):
+        """Remove the files of the old manifest which weren't generated in this run, if is_stale(entry) says so
+
+        Only files of the current format can be stale, the files of the other formats are kept.
+        """
+        for path, entry in self.old_files.items():
+            if path in self.files:
+                continue
+            # manifests of older versions only contain png files
+            entry.setdefault("format", "png")
+            if entry["format"] != self.image_format or not is_stale(entry):
+                self.files[path] = entry
+                continue
+            if os.path.exists(path):
+                os.remove(path)
+            self.stats["removed"] += 1
+
+        used = {
+            self.object_path(e["hash"], e.get("format", "png"))
+            for e in self.files.values()
+        }
+        for name in os.listdir(self.objects):
+            object_path = os.path.join(self.objects, name)
+            if object_path not in used:
+                os.remove(object_path)
+
+    def save(self):
+        # write to a temporary file first, so that an aborted run can't corrupt the manifest
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"files": self.files}, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def close(self):
+        print(
+            f"rendered={self.stats['rendered']} linked={self.stats['linked']} unchanged={self.stats['unchanged']} removed={self.stats['removed']}"
+        )
+
+
+class ZipOutput:
+    """Writes all qr codes as png into one zip archive
+
+    Every image is written as soon as it is rendered, so the images are never kept in memory.
+    """
+
+    def __init__(self, path: str):
+        # png is already compressed
+        self.archive = zipfile.ZipFile(path, "w", zipfile.ZIP_STORED)
+        self.names = set()
+        self.written = 0
+
+    def reserve_name(self, network_id: str, network_name: str, ssid: str) -> str:
+        """Return an unused file name for the archive and mark it as used"""
+        name = f"{network_name}_{ssid}.png"
+        counter = 1
+        while name in self.names:
+            suffix = f"_{counter}" if counter > 1 else ""
+            name = f"{network_name}_{network_id}_{ssid}{suffix}.png"
+            counter += 1
+        self.names.add(name)
+        return name
+
+    async def add(
+        self,
+        executor: ProcessPoolExecutor,
+        code: str,
+        network_id: str,
+        network_name: str,
+        ssid: str,
+    ):
+        # the name is reserved before the rendering, other jobs with the same name run at the same time
+        name = self.reserve_name(network_id, network_name, ssid)
+        try:
+            data = await asyncio.get_running_loop().run_in_executor(
+                executor, render_qrcode_png, code
+            )
+        except Exception as e:
+            print(f"Unable to generate {name}: {e}")
+            self.names.discard(name)
+            return
+        self.archive.writestr(name, data)
+        self.written += 1
+
+    def close(self):
+        self.archive.close()
+        print(f"{self.written} qr codes written to {self.archive.filename}")
+
+
+def pdf_string(text: str) -> str:
+    """Escape the text for a pdf string literal"""
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+class PDFOutput:
+    """Writes all qr codes into a multi page pdf with one labeled code per page
+
+    Every page is written as soon as it is rendered, only the offsets of the pdf objects are kept in memory.
+    """
+
+    # A4 in points
+    PAGE_WIDTH = 595
+    PAGE_HEIGHT = 842
+    CODE_SIZE = 400
+
+    # object ids of the objects which are written at the end
+    CATALOG = 1
+    PAGES = 2
+    FONT = 3
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, "wb")
+        self.offsets = {}
+        self.pages = []
+        self.next_id = 4
+        self.file.write(b"%PDF-1.4\n")
+        self.write_object(
+            self.FONT, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"
+        )
+
+    def write_object(self, object_id: int, body: bytes, stream: bytes = None):
+        self.offsets[object_id] = self.file.tell()
+        self.file.write(f"{object_id} 0 obj\n".encode() + body)
+        if stream is not None:
+            self.file.write(b"\nstream\n" + stream + b"\nendstream")
+        self.file.write(b"\nendobj\n")
+
+    async def add(
+        self,
+        executor: ProcessPoolExecutor,
+        code: str,
+        network_id: str,
+        network_name: str,
+        ssid: str,
+    ):
+        label = f"{network_name} - {ssid}"
+        try:
+            width, height, data = await asyncio.get_running_loop().run_in_executor(
+                executor, render_qrcode_bitmap, code
+            )
+        except Exception as e:
+            print(f"Unable to generate {label}: {e}")
+            return
+
+        image_id, content_id, page_id = range(self.next_id, self.next_id + 3)
+        self.next_id += 3
+        self.write_object(
+            image_id,
+            f"<< /Type /XObject /Subtype /Image /Width {width} /Height {height} /ColorSpace /DeviceGray /BitsPerComponent 1 /Filter /FlateDecode /Length {len(data)} >>".encode(),
+            data,
+        )
+        x = (self.PAGE_WIDTH - self.CODE_SIZE) // 2
+        y = (self.PAGE_HEIGHT - self.CODE_SIZE) // 2
+        content = (
+            f"q {self.CODE_SIZE} 0 0 {self.CODE_SIZE} {x} {y} cm /Code Do Q "
+            f"BT /F1 18 Tf {x} {y + self.CODE_SIZE + 30} Td ({pdf_string(label)}) Tj ET"
+        ).encode("latin-1", "replace")
+        self.write_object(
+            content_id, f"<< /Length {len(content)} >>".encode(), content
+        )
+        self.write_object(
+            page_id,
+            (
+                f"<< /Type /Page /Parent {self.PAGES} 0 R /MediaBox [0 0 {self.PAGE_WIDTH} {self.PAGE_HEIGHT}] "
+                f"/Resources << /XObject << /Code {image_id} 0 R >> /Font << /F1 {self.FONT} 0 R >> >> "
+                f"/Contents {content_id} 0 R >>"
+            ).encode(),
+        )
+        self.pages.append(page_id)
+
+    def close(self):
+        kids = " ".join(f"{p} 0 R" for p in self.pages)
+        self.write_object(
+            self.PAGES,
+            f"<< /Type /Pages /Kids [{kids}] /Count {len(self.pages)} >>".encode(),
+        )
+        self.write_object(
+            self.CATALOG, f"<< /Type /Catalog /Pages {self.PAGES} 0 R >>".encode()
+        )
+        xref = self.file.tell()
+        self.file.write(f"xref\n0 {self.next_id}\n0000000000 65535 f \n".encode())
+        for object_id in range(1, self.next_id):
+            self.file.write(f"{self.offsets[object_id]:010d} 00000 n \n".encode())
+        self.file.write(
+            f"trailer\n<< /Size {self.next_id} /Root {self.CATALOG} 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+        )
+        self.file.close()
+        print(f"{len(self.pages)} qr codes written to {self.path}")
+
+
+async def render_worker(queue: asyncio.Queue, executor: ProcessPoolExecutor, output):
+    """Take the codes from the queue and render them in the process pool into the output"""
+    while True:
+        job = await queue.get()
+        if job is None:
+            return
+        await output.add(executor, *job)
+
+
 async def get_ssid_settings(
     aiomeraki: meraki.aio.AsyncDashboardAPI,
     network_id: str,
     network_name: str,
     ssids: str,
+    queue: asyncio.Queue,
 ):
     network_ssids = await aiomeraki.wireless.getNetworkWirelessSsids(network_id)
     for network_ssid in network_ssids:
@@ -43,8 +377,7 @@ async def get_ssid_settings(
         ssid = network_ssid["name"]
         print(f"Generating image for {network_name}-{ssid}")
         code = wifi_code(ssid, hidden, encryptionMode, password)
-        img = qrcode.make(code)
-        img.save(f"./img/{network_name}_{ssid}.png")
+        await queue.put((code, network_id, network_name, ssid))
 
 
 async def main():
@@ -81,6 +414,35 @@ async def main():
         help="the name of the ssids to generate the qr codes",
     )
 
+    parser.add_argument(
+        "-p",
+        "--processes",
+        type=int,
+        dest="processes",
+        default=os.cpu_count(),
+        required=False,
+        help="the number of processes which render the qr codes. Default: number of cpus",
+    )
+
+    parser.add_argument(
+        "-m",
+        "--mode",
+        type=str,
+        dest="mode",
+        choices=OUTPUT_MODES,
+        default="png",
+        required=False,
+        help="png/svg: one image per ssid in ./img/, zip: all png images in one archive, pdf: one labeled page per ssid. Default: png",
+    )
+
+    parser.add_argument(
+        "--output",
+        type=str,
+        dest="output",
+        required=False,
+        help="the file for the zip and pdf mode. Default: qrcodes.zip/qrcodes.pdf",
+    )
+
     if len(sys.argv) < 2:
         parser.print_help()
         return
@@ -140,15 +502,43 @@ async def main():
                 continue
             networIdNameMap[network["id"]] = network["name"]
 
-        if not os.path.exists("./img/"):
-            os.makedirs("./img/")
+        if args.mode == "zip":
+            output = ZipOutput(args.output or "qrcodes.zip")
+        elif args.mode == "pdf":
+            output = PDFOutput(args.output or "qrcodes.pdf")
+        else:
+            if not os.path.exists("./img/"):
+                os.makedirs("./img/")
+            output = QRCodeCache("./img/", args.mode)
+
+        # the images are rendered in a process pool while the ssids are still downloaded.
+        # The queue is bounded, so the pending codes don't pile up if the rendering is slower
+        queue = asyncio.Queue(maxsize=args.processes * 4)
+        with ProcessPoolExecutor(max_workers=args.processes) as executor:
+            # two workers per process, so that every process gets the next code right away
+            workers = [
+                asyncio.ensure_future(render_worker(queue, executor, output))
+                for _ in range(args.processes * 2)
+            ]
+            ssid_tasks = [
+                get_ssid_settings(aiomeraki, id, name, args.ssids, queue)
+                for id, name in networIdNameMap.items()
+            ]
+            for task in asyncio.as_completed(ssid_tasks):
+                ssid = await task
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
 
-        ssid_tasks = [
-            get_ssid_settings(aiomeraki, id, name, args.ssids)
-            for id, name in networIdNameMap.items()
-        ]
-        for task in asyncio.as_completed(ssid_tasks):
-            ssid = await task
+        if isinstance(output, QRCodeCache):
+            # only remove the files of the networks and ssids which were part of this run
+            all_networks = args.organization and not args.networks
+            output.remove_stale(
+                lambda e: (all_networks or e["network"] in networIdNameMap)
+                and (not args.ssids or e["ssid"] in args.ssids)
+            )
+            output.save()
+        output.close()
         print("Script complete!")
 
 